@@ -0,0 +1,357 @@
+"""
+Benchmark sin conexión del chatbot.
+
+Reemplaza ChatGroq por un modelo falso determinístico con latencia
+configurable, usa el backend de Gmail en memoria (GMAIL_BACKEND=falso),
+genera una base SQLite con el esquema de usuarios/cargos/asignaturas y
+reproduce conversaciones guionadas contra /chat con la concurrencia pedida.
+Informa latencias p50/p95/p99, throughput y el desglose por etapa, y verifica
+el clasificador por reglas del router con una tabla de frases frecuentes.
+
+Uso:
+    python benchmark.py --legajos 20000 --sesiones 1,4,8 --turnos 6 --latencia-llm 0.3
+    python benchmark.py --umbral-p95-ms 2500   # sale con código 1 si se supera
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from prueba_carga import imprimir_tabla, medir_concurrencia
+
+CONVERSACIONES = [
+    ["hola", "no puedo ingresar al sistema", "olvidé mi contraseña", "mi legajo es {legajo}", "gracias"],
+    ["buenas tardes", "qué materias doy? legajo {legajo}", "y a qué carrera pertenezco?", "gracias"],
+    ["no me aparece la materia", "mi legajo es {legajo}", "la materia es Física II", "ok, gracias"],
+    ["hola", "qué servicios ofrecen?", "no me anda el wifi de la facultad", "chau"],
+]
+
+# Frases frecuentes y lo que debe hacer el clasificador por reglas: el tipo, o None si la
+# decisión tiene que quedar para el LLM (p. ej. problemas que mencionan materias)
+CASOS_ROUTER = [
+    ("hola", "GENERAL"),
+    ("buen día", "GENERAL"),
+    ("no puedo ingresar al sistema", "SRAT"),
+    ("olvidé mi contraseña", "SRAT"),
+    ("no me aparece la materia", "SRAT"),
+    ("qué materias doy? legajo 50443", "DATABASE"),
+    ("mis materias", "DATABASE"),
+    ("no me aparecen mis materias", None),
+    ("no me aparecen mis materias en el sistema", None),
+    ("no puedo ver mis carreras", None),
+]
+
+MATERIAS = ["Álgebra", "Análisis Matemático", "Física", "Química", "Sistemas de Representación",
+            "Probabilidad y Estadística", "Programación", "Estructuras", "Termodinámica", "Economía"]
+CARRERAS = ["Ingeniería en Sistemas de Información", "Ingeniería Civil", "Ingeniería Eléctrica",
+            "Ingeniería Mecánica", "Ingeniería Química", "Licenciatura en Administración Rural"]
+
+
+# =============================================================================
+# MEDICIÓN POR ETAPA
+# =============================================================================
+
+class Etapas:
+    """Acumula el tiempo gastado en cada etapa (router, agente, SQL, ...) entre todos los hilos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.segundos = defaultdict(float)
+        self.llamadas = defaultdict(int)
+
+    def registrar(self, etapa, segundos):
+        with self._lock:
+            self.segundos[etapa] += segundos
+            self.llamadas[etapa] += 1
+
+    def registrar_total(self, etapa, segundos, llamadas):
+        with self._lock:
+            self.segundos[etapa] += segundos
+            self.llamadas[etapa] += llamadas
+
+    def reiniciar(self):
+        with self._lock:
+            self.segundos.clear()
+            self.llamadas.clear()
+
+
+etapas = Etapas()
+
+
+# =============================================================================
+# MODELO FALSO
+# =============================================================================
+
+class ModeloChatFalso(BaseChatModel):
+    """
+    Modelo de chat determinístico que imita lo suficiente al LLM real: clasifica
+    para el router, resume para el contexto, llama a las herramientas de consulta
+    académica cuando hay un legajo y responde texto fijo en el resto de los
+    casos. Con un limitador, cada llamada espera su turno como las de
+    ChatGroqLimitado, así que LLM_MAX_CONCURRENTES y la cola también se miden.
+    """
+
+    latencia_segundos: float = 0.3
+    herramientas: list = []
+    limitador: object = None
+
+    @property
+    def _llm_type(self):
+        return "falso"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"herramientas": [getattr(t, "name", str(t)) for t in tools]})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.limitador is None:
+            return self._generar(messages)
+        inicio = time.perf_counter()
+        with self.limitador.turno(sum(len(str(m.content)) for m in messages) // 4):
+            etapas.registrar("espera_llm", time.perf_counter() - inicio)
+            return self._generar(messages)
+
+    def _generar(self, messages):
+        inicio = time.perf_counter()
+        time.sleep(self.latencia_segundos)
+        sistema = str(messages[0].content)
+        ultimo = messages[-1]
+
+        if "clasificador de consultas" in sistema:
+            etapa, mensaje = "router_llm", AIMessage(content=self._clasificar(str(ultimo.content)))
+        elif "Resumís conversaciones" in sistema:
+            etapa, mensaje = "resumen_llm", AIMessage(content="El usuario consultó por el sistema de carga de temas.")
+        else:
+            etapa, mensaje = "agente_llm", self._responder(messages)
+
+        mensaje.usage_metadata = {
+            "input_tokens": sum(len(str(m.content)) for m in messages) // 4,
+            "output_tokens": len(str(mensaje.content)) // 4 + 1,
+            "total_tokens": sum(len(str(m.content)) for m in messages) // 4 + len(str(mensaje.content)) // 4 + 1,
+        }
+        etapas.registrar(etapa, time.perf_counter() - inicio)
+        return ChatResult(generations=[ChatGeneration(message=mensaje)])
+
+    @staticmethod
+    def _clasificar(texto):
+        texto = texto.lower()
+        if re.search(r"materia|carrera|legajo", texto):
+            return "DATABASE"
+        if re.search(r"sistema|ingres|contrase|wifi|tema", texto):
+            return "SRAT"
+        return "GENERAL"
+
+    def _responder(self, messages):
+        ultimo = messages[-1]
+        if ultimo.type == "tool":
+            return AIMessage(content="Te envié la información a tu correo institucional asociado al legajo.")
+        # El legajo puede venir en el mensaje o en el contexto (resumen/legajo recordado)
+        match = next((m for m in (re.search(r"\b(\d{4,6})\b", str(x.content)) for x in reversed(messages)) if m), None)
+        if match and "consultar_usuario_asignaturas" in self.herramientas:
+            return AIMessage(content="", tool_calls=[{
+                "name": "consultar_usuario_asignaturas",
+                "args": {"__arg1": match.group(1)},
+                "id": f"consulta-{match.group(1)}",
+            }])
+        return AIMessage(content="Puedo ayudarte con el sistema de carga de temas o con consultas académicas.")
+
+
+# =============================================================================
+# BASE DE DATOS DE PRUEBA
+# =============================================================================
+
+def generar_base(ruta, cantidad_legajos, semilla=1):
+    """Crea una base SQLite con el esquema académico y datos de volumen realista"""
+    azar = random.Random(semilla)
+    conexion = sqlite3.connect(ruta)
+    conexion.executescript("""
+        DROP TABLE IF EXISTS usuarios;
+        DROP TABLE IF EXISTS cargos;
+        DROP TABLE IF EXISTS asignaturas;
+        DROP TABLE IF EXISTS asignaturas_materias;
+        DROP TABLE IF EXISTS asignaturas_carreras;
+        CREATE TABLE usuarios (id INTEGER PRIMARY KEY, legajo INTEGER NOT NULL, nombre TEXT, apellido TEXT, email TEXT);
+        CREATE TABLE cargos (id INTEGER PRIMARY KEY, usuario_id INTEGER NOT NULL, asignatura_id INTEGER NOT NULL);
+        CREATE TABLE asignaturas (id INTEGER PRIMARY KEY, materia_id INTEGER NOT NULL, carrera_id INTEGER NOT NULL);
+        CREATE TABLE asignaturas_materias (id INTEGER PRIMARY KEY, nombre TEXT NOT NULL);
+        CREATE TABLE asignaturas_carreras (id INTEGER PRIMARY KEY, nombre TEXT NOT NULL);
+        CREATE INDEX idx_usuarios_legajo ON usuarios (legajo);
+        CREATE INDEX idx_cargos_usuario ON cargos (usuario_id);
+    """)
+    materias = [(i + 1, f"{nombre} {nivel}") for i, (nombre, nivel) in
+                enumerate((n, nv) for n in MATERIAS for nv in ("I", "II", "III", "IV"))]
+    carreras = list(enumerate(CARRERAS, start=1))
+    asignaturas = [(i + 1, materia_id, carrera_id) for i, (materia_id, carrera_id) in
+                   enumerate((m, c) for m, _ in materias for c, _ in carreras)]
+    conexion.executemany("INSERT INTO asignaturas_materias VALUES (?, ?)", materias)
+    conexion.executemany("INSERT INTO asignaturas_carreras VALUES (?, ?)", carreras)
+    conexion.executemany("INSERT INTO asignaturas VALUES (?, ?, ?)", asignaturas)
+
+    usuarios, cargos = [], []
+    for usuario_id in range(1, cantidad_legajos + 1):
+        legajo = 10000 + usuario_id
+        email = f"docente{legajo}@frd.utn.edu.ar" if azar.random() < 0.95 else None
+        usuarios.append((usuario_id, legajo, f"Nombre{usuario_id}", f"Apellido{usuario_id}", email))
+        for asignatura_id in azar.sample(range(1, len(asignaturas) + 1), azar.randint(1, 4)):
+            cargos.append((usuario_id, asignatura_id))
+    conexion.executemany("INSERT INTO usuarios VALUES (?, ?, ?, ?, ?)", usuarios)
+    conexion.executemany("INSERT INTO cargos (usuario_id, asignatura_id) VALUES (?, ?)", cargos)
+    conexion.commit()
+    conexion.close()
+    return [u[1] for u in usuarios]
+
+
+# =============================================================================
+# EJECUCIÓN
+# =============================================================================
+
+def crear_simulador(app, legajos):
+    """Sesión en proceso: usa el cliente de pruebas de Flask (cookie propia por sesión)"""
+    contador = itertools.count()
+
+    def simular(_url, turnos, conversaciones, latencias, errores, lock):
+        numero = next(contador)
+        # Los guiones se reparten en orden para cubrir todos los flujos
+        guion = conversaciones[numero % len(conversaciones)]
+        legajo = random.Random(numero).choice(legajos)
+        cliente = app.test_client()
+        for i in range(turnos):
+            mensaje = guion[i % len(guion)].format(legajo=legajo)
+            inicio = time.perf_counter()
+            respuesta = cliente.post('/chat', json={"message": mensaje})
+            duracion = time.perf_counter() - inicio
+            with lock:
+                if respuesta.status_code == 200:
+                    latencias.append(duracion)
+                else:
+                    errores.append(f"HTTP {respuesta.status_code}")
+
+    return simular
+
+
+def registrar_sql(aplicacion, antes):
+    """
+    Pasa a la etapa 'sql' lo que main registró en su histograma desde `antes`
+    (las consultas ya se instrumentan en main con instrumentar_sql)
+    """
+    segundos, consultas = aplicacion.histograma_etapas.totales(etapa="sql")
+    etapas.registrar_total("sql", segundos - antes[0], consultas - antes[1])
+
+
+# Etapas que corren después de responder: se muestran, pero no forman parte del tiempo de respuesta
+ETAPAS_SEGUNDO_PLANO = ("resumen_llm",)
+
+
+def desglosar_etapas(resultado):
+    """ms por petición de cada etapa; 'aplicacion' es el resto del tiempo de respuesta"""
+    peticiones = max(resultado["peticiones"], 1)
+    desglose = {etapa: segundos / peticiones * 1000 for etapa, segundos in etapas.segundos.items()}
+    en_respuesta = sum(ms for etapa, ms in desglose.items() if etapa not in ETAPAS_SEGUNDO_PLANO)
+    desglose["aplicacion"] = max(resultado["media_ms"] - en_respuesta, 0.0)
+    return desglose
+
+
+def imprimir_etapas(resultado):
+    desglose = resultado["etapas_ms_por_peticion"]
+    print(f"{'etapa':>14} {'llamadas':>9} {'ms/petición':>12} {'% del total':>12}")
+    for etapa, ms in sorted(desglose.items(), key=lambda kv: kv[1], reverse=True):
+        porcentaje = ms / resultado["media_ms"] * 100 if resultado["media_ms"] else 0.0
+        llamadas = etapas.llamadas.get(etapa, resultado["peticiones"])
+        print(f"{etapa:>14} {llamadas:>9} {ms:>12.1f} {porcentaje:>11.1f}%")
+
+
+def verificar_router(aplicacion):
+    """Compara CASOS_ROUTER con el clasificador por reglas; retorna los casos que no coinciden"""
+    umbral = aplicacion.app.config['ROUTER_UMBRAL_CONFIANZA']
+    fallas = []
+    print(f"{'mensaje':<45} {'esperado':>9} {'reglas':>9} {'confianza':>9}")
+    for mensaje, esperado in CASOS_ROUTER:
+        tipo, confianza = aplicacion.clasificar_por_reglas(mensaje, 'GENERAL')
+        obtenido = tipo if confianza >= umbral else None
+        print(f"{mensaje:<45} {esperado or 'LLM':>9} {obtenido or 'LLM':>9} {confianza:>9.2f}")
+        if obtenido != esperado:
+            fallas.append(mensaje)
+    return fallas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del chatbot sin Groq, Gmail ni MySQL")
+    parser.add_argument("--legajos", type=int, default=20000, help="legajos a generar en la base SQLite")
+    parser.add_argument("--sesiones", default="1,4,8", help="niveles de concurrencia separados por coma")
+    parser.add_argument("--turnos", type=int, default=5, help="mensajes por sesión")
+    parser.add_argument("--latencia-llm", type=float, default=0.3, help="segundos por llamada al modelo falso")
+    parser.add_argument("--json", help="guardar los resultados en este archivo")
+    parser.add_argument("--umbral-p95-ms", type=float, help="falla si el p95 de algún nivel lo supera")
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix="srat-benchmark-")
+    ruta_base = os.path.join(directorio, "srat.db")
+    inicio = time.perf_counter()
+    legajos = generar_base(ruta_base, args.legajos)
+    print(f"Base SQLite con {len(legajos)} legajos generada en {time.perf_counter() - inicio:.1f}s ({ruta_base})")
+
+    # Configuración sin servicios externos, antes de importar la aplicación
+    os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{ruta_base}"
+    os.environ["GMAIL_BACKEND"] = "falso"
+    os.environ["CORREO_SPOOL"] = os.path.join(directorio, "correo_spool.db")
+    os.environ["ROUTER_CACHE_SQLITE"] = ""
+    # El historial va a otra base para que sus escrituras en segundo plano no se sumen a la etapa SQL
+    os.environ["HISTORIAL_DB_URI"] = f"sqlite:///{os.path.join(directorio, 'historial.db')}"
+    os.environ.setdefault("GROQ_API_KEY", "benchmark")
+    # El modelo falso no tiene límites de proveedor por minuto; el límite de
+    # llamadas simultáneas (LLM_MAX_CONCURRENTES) y la cola sí se aplican
+    os.environ["LLM_RPM"] = "0"
+    os.environ["LLM_TPM"] = "0"
+
+    import main as aplicacion
+    modelo = ModeloChatFalso(latencia_segundos=args.latencia_llm, limitador=aplicacion.limitador_llm)
+    aplicacion.configurar_modelos(modelo, modelo)
+    # Los agentes se compilan antes de medir para que no cuenten en la primera petición
+    aplicacion.precalentar()
+
+    fallas_router = verificar_router(aplicacion)
+
+    resultados = []
+    for sesiones in (int(n) for n in args.sesiones.split(",")):
+        etapas.reiniciar()
+        sql_antes = aplicacion.histograma_etapas.totales(etapa="sql")
+        resultado = medir_concurrencia(None, sesiones, args.turnos, CONVERSACIONES,
+                                       simular=crear_simulador(aplicacion.app, legajos))
+        registrar_sql(aplicacion, sql_antes)
+        resultado["etapas_ms_por_peticion"] = desglosar_etapas(resultado)
+        resultados.append(resultado)
+        print(f"\n== {sesiones} sesiones concurrentes ==")
+        imprimir_etapas(resultado)
+
+    print()
+    imprimir_tabla(resultados)
+    aplicacion.cola_correos.esperar()
+    print(f"\nCorreos enviados al backend falso: {len(aplicacion.backend_correo.enviados)}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as archivo:
+            json.dump(resultados, archivo, indent=2, ensure_ascii=False)
+
+    if fallas_router:
+        print(f"\nREGRESIÓN: el clasificador por reglas no coincide en {fallas_router}")
+        raise SystemExit(1)
+
+    if args.umbral_p95_ms is not None:
+        peores = [r for r in resultados if r["p95_ms"] > args.umbral_p95_ms]
+        if peores:
+            print(f"\nREGRESIÓN: p95 por encima de {args.umbral_p95_ms:.0f}ms en {[r['sesiones'] for r in peores]} sesiones")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,1336 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 import dotenv
-from langchain_groq import ChatGroq
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langgraph.prebuilt import create_react_agent
-from langchain_google_community import GmailToolkit
-from langchain_google_community.gmail.utils import build_resource_service, get_gmail_credentials
-from langchain.tools import Tool
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import (Column, Float, Integer, MetaData, String, Table, Text, bindparam,
+                        create_engine, delete, event, insert, select, text, update)
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+import atexit
+import click
 import os
 import json
+import logging
+import math
+import queue
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+
+# Tiempo de importación de los módulos pesados, para seguir las regresiones de
+# arranque en frío. Cada valor es incremental: no incluye lo que ya se importó antes.
+# Los módulos de Google se importan recién al inicializar Gmail.
+TIEMPOS_IMPORTACION_MS = {}
+_inicio_carga = time.perf_counter()
+
+
+@contextmanager
+def medir_importacion(nombre):
+    inicio = time.perf_counter()
+    yield
+    duracion_ms = (time.perf_counter() - inicio) * 1000
+    TIEMPOS_IMPORTACION_MS[nombre] = round(TIEMPOS_IMPORTACION_MS.get(nombre, 0) + duracion_ms, 1)
+
+
+with medir_importacion("langchain_core"):
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.runnables import RunnableConfig
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage, trim_messages
+    from langchain_core.tools import StructuredTool
+with medir_importacion("langchain_groq"):
+    import groq
+    from langchain_groq import ChatGroq
+with medir_importacion("langchain_community"):
+    from langchain_community.chat_message_histories import ChatMessageHistory
+with medir_importacion("langgraph"):
+    from langgraph.prebuilt import create_react_agent
+with medir_importacion("langchain"):
+    from langchain.tools import Tool
 
 dotenv.load_dotenv()
 app = Flask(__name__)
 
+# Logging (LOG_LEVEL=DEBUG muestra tiempos por etapa e historial de cada sesión)
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger("srat_chat")
+
+# Obtener la ruta del directorio actual del script
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
 # Configuración de la base de datos
-app.config['SQLALCHEMY_DATABASE_URI'] = "mysql://root:@localhost:3306/srat"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', "mysql://root:@localhost:3306/srat")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Pool de conexiones (SQLite no admite tamaño de pool, solo pre-ping)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+}
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_POOL_MAX_OVERFLOW', '10')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+    })
+
+# Caché de información académica por legajo
+app.config['LEGAJOS_CACHE_MAX'] = int(os.getenv('LEGAJOS_CACHE_MAX', '5000'))
+app.config['LEGAJOS_CACHE_TTL_SEGUNDOS'] = int(os.getenv('LEGAJOS_CACHE_TTL_SEGUNDOS', '600'))
+
+# Snapshot en memoria de legajo -> materias/carreras/email (SNAPSHOT_REFRESCO_SEGUNDOS=0: solo manual)
+app.config['SNAPSHOT_ACADEMICO'] = os.getenv('SNAPSHOT_ACADEMICO', '0') == '1'
+app.config['SNAPSHOT_REFRESCO_SEGUNDOS'] = int(os.getenv('SNAPSHOT_REFRESCO_SEGUNDOS', '0'))
+
+# Token para los endpoints de administración (vacío = deshabilitados)
+app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN', '')
+
 # Inicializar SQLAlchemy
 db = SQLAlchemy(app)
 
-# LLM
-llm = ChatGroq(model_name='llama-3.3-70b-versatile')
+# Configuración de sesiones (una conversación por navegador/PC)
+app.config['SESIONES_MAX'] = int(os.getenv('SESIONES_MAX', '500'))
+app.config['SESIONES_TTL_SEGUNDOS'] = int(os.getenv('SESIONES_TTL_SEGUNDOS', '1800'))
+app.config['SESIONES_MAX_BYTES'] = int(os.getenv('SESIONES_MAX_BYTES', str(50 * 1024 * 1024)))
+app.config['SESION_COOKIE'] = 'srat_sesion'
+
+# Contexto de los agentes: turnos textuales, turnos que se pliegan juntos en el resumen
+# y presupuesto de tokens por agente
+app.config['CONTEXTO_TURNOS_VERBATIM'] = int(os.getenv('CONTEXTO_TURNOS_VERBATIM', '6'))
+app.config['CONTEXTO_LOTE_RESUMEN'] = int(os.getenv('CONTEXTO_LOTE_RESUMEN', '4'))
+app.config['CONTEXTO_PRESUPUESTO_TOKENS'] = {
+    'SRAT': int(os.getenv('CONTEXTO_TOKENS_SRAT', '3000')),
+    'DATABASE': int(os.getenv('CONTEXTO_TOKENS_DATABASE', '3000')),
+    'GENERAL': int(os.getenv('CONTEXTO_TOKENS_GENERAL', '1000')),
+}
+
+# Router: confianza mínima del clasificador por reglas para no consultar al LLM
+app.config['ROUTER_UMBRAL_CONFIANZA'] = float(os.getenv('ROUTER_UMBRAL_CONFIANZA', '0.6'))
+
+# Motor de intenciones: "mis materias", "y mi email?" con el legajo recordado se resuelven
+# antes del router, sin LLM (0 = todo pasa por el router y los agentes)
+app.config['INTENCIONES'] = os.getenv('INTENCIONES', '1') == '1'
+
+# Caché de clasificaciones del router (ROUTER_CACHE_SQLITE vacío = solo memoria)
+app.config['ROUTER_CACHE_MAX'] = int(os.getenv('ROUTER_CACHE_MAX', '2000'))
+app.config['ROUTER_CACHE_TTL_SEGUNDOS'] = int(os.getenv('ROUTER_CACHE_TTL_SEGUNDOS', '86400'))
+app.config['ROUTER_CACHE_SQLITE'] = os.getenv('ROUTER_CACHE_SQLITE', '')
+
+# Caché semántica de respuestas del agente SRAT (preguntas frecuentes sin datos personales).
+# CACHE_SEMANTICA_MODELO: modelo local de sentence-transformers; vacío o no instalado = TF-IDF.
+# CACHE_SEMANTICA_UMBRAL vacío = umbral por defecto del vectorizador
+app.config['CACHE_SEMANTICA'] = os.getenv('CACHE_SEMANTICA', '1') == '1'
+app.config['CACHE_SEMANTICA_MODELO'] = os.getenv('CACHE_SEMANTICA_MODELO', '')
+app.config['CACHE_SEMANTICA_UMBRAL'] = os.getenv('CACHE_SEMANTICA_UMBRAL', '')
+app.config['CACHE_SEMANTICA_MAX'] = int(os.getenv('CACHE_SEMANTICA_MAX', '500'))
+app.config['CACHE_SEMANTICA_TTL_SEGUNDOS'] = int(os.getenv('CACHE_SEMANTICA_TTL_SEGUNDOS', '86400'))
+
+# Servidor: 'desarrollo' usa el servidor de Flask, 'produccion' usa waitress con varios hilos
+app.config['MODO_SERVIDOR'] = os.getenv('MODO_SERVIDOR', 'desarrollo')
+app.config['SERVIDOR_HILOS'] = int(os.getenv('SERVIDOR_HILOS', '16'))
+app.config['SERVIDOR_PUERTO'] = int(os.getenv('SERVIDOR_PUERTO', '5000'))
+
+# Precalentamiento: al iniciar el servidor, un hilo crea el LLM, Gmail y los agentes
+# en segundo plano (si no, se crean con la primera consulta que los necesita)
+app.config['PRECALENTAR'] = os.getenv('PRECALENTAR', '1') == '1'
+
+# Máximo de llamadas simultáneas al LLM entre todas las sesiones
+app.config['LLM_MAX_CONCURRENTES'] = int(os.getenv('LLM_MAX_CONCURRENTES', '8'))
+
+# Límites del proveedor por minuto (0 = sin límite; por defecto los del plan gratuito de Groq
+# para llama-3.3-70b-versatile), llamadas que pueden esperar turno y espera máxima antes de
+# responder "ocupado", y reintentos ante errores 429
+app.config['LLM_RPM'] = int(os.getenv('LLM_RPM', '30'))
+app.config['LLM_TPM'] = int(os.getenv('LLM_TPM', '12000'))
+app.config['LLM_COLA_MAX'] = int(os.getenv('LLM_COLA_MAX', '32'))
+app.config['LLM_ESPERA_MAX_SEGUNDOS'] = float(os.getenv('LLM_ESPERA_MAX_SEGUNDOS', '20'))
+app.config['LLM_REINTENTOS'] = int(os.getenv('LLM_REINTENTOS', '3'))
+app.config['LLM_BACKOFF_SEGUNDOS'] = float(os.getenv('LLM_BACKOFF_SEGUNDOS', '1'))
+
+# Especulación: mientras el router consulta al LLM se ejecuta en paralelo el agente del
+# turno anterior (se usa si la clasificación coincide, si no se descarta)
+app.config['ESPECULACION'] = os.getenv('ESPECULACION', '0') == '1'
+
+# Envío de correos: 'gmail' usa la API real, 'falso' los guarda en memoria (pruebas sin conexión)
+app.config['GMAIL_BACKEND'] = os.getenv('GMAIL_BACKEND', 'gmail')
+app.config['CORREO_SPOOL'] = os.getenv('CORREO_SPOOL', os.path.join(script_dir, "correo_spool.db"))
+app.config['CORREO_WORKERS'] = int(os.getenv('CORREO_WORKERS', '2'))
+app.config['CORREO_MAX_INTENTOS'] = int(os.getenv('CORREO_MAX_INTENTOS', '5'))
+app.config['CORREO_BACKOFF_SEGUNDOS'] = float(os.getenv('CORREO_BACKOFF_SEGUNDOS', '2'))
+
+# Envío masivo de información académica (flask envio-masivo / POST /admin/envio-masivo):
+# correos por minuto que entrega a la cola (0 = sin límite), ráfaga inicial y legajos por consulta
+app.config['ENVIO_MASIVO_POR_MINUTO'] = int(os.getenv('ENVIO_MASIVO_POR_MINUTO', '120'))
+app.config['ENVIO_MASIVO_RAFAGA'] = int(os.getenv('ENVIO_MASIVO_RAFAGA', '10'))
+app.config['ENVIO_MASIVO_BLOQUE'] = int(os.getenv('ENVIO_MASIVO_BLOQUE', '500'))
+
+# Historial persistente: 'sql' guarda las conversaciones (HISTORIAL_DB_URI vacío = misma base
+# que la app; las tablas se crean en segundo plano), 'memoria' no las persiste.
+# Las escrituras se agrupan cada HISTORIAL_FLUSH_SEGUNDOS
+app.config['HISTORIAL_BACKEND'] = os.getenv('HISTORIAL_BACKEND', 'memoria')
+app.config['HISTORIAL_DB_URI'] = os.getenv('HISTORIAL_DB_URI', '')
+app.config['HISTORIAL_FLUSH_SEGUNDOS'] = float(os.getenv('HISTORIAL_FLUSH_SEGUNDOS', '2'))
+app.config['HISTORIAL_LOTE_MAX'] = int(os.getenv('HISTORIAL_LOTE_MAX', '500'))
+app.config['HISTORIAL_RETENCION_DIAS'] = int(os.getenv('HISTORIAL_RETENCION_DIAS', '90'))
+app.config['HISTORIAL_PODA_SEGUNDOS'] = int(os.getenv('HISTORIAL_PODA_SEGUNDOS', '3600'))
+
+# =============================================================================
+# MÉTRICAS - Tiempos por etapa, tokens y exportación en formato Prometheus
+# =============================================================================
+
+LIMITES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LIMITES_SIMILITUD = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0)
+
+
+def _formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ""
+    pares = []
+    for nombre, valor in etiquetas:
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+
+class Contador:
+    """Contador con etiquetas, exportable en formato Prometheus"""
+
+    def __init__(self, nombre, descripcion):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, valor=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            self._series[clave] = self._series.get(clave, 0) + valor
+
+    def renderizar(self):
+        lineas = [f"# HELP {self.nombre} {self.descripcion}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            for clave, valor in sorted(self._series.items()):
+                lineas.append(f"{self.nombre}{_formatear_etiquetas(clave)} {valor}")
+        return "\n".join(lineas)
+
+
+class Histograma:
+    """Histograma acumulativo con etiquetas, exportable en formato Prometheus"""
+
+    def __init__(self, nombre, descripcion, limites=LIMITES_SEGUNDOS):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self.limites = limites
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * len(self.limites), 0.0, 0]
+            for i, limite in enumerate(self.limites):
+                if valor <= limite:
+                    serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def totales(self, **etiquetas):
+        """(suma, cantidad) de las observaciones con esas etiquetas"""
+        with self._lock:
+            serie = self._series.get(tuple(sorted(etiquetas.items())))
+            return (serie[1], serie[2]) if serie is not None else (0.0, 0)
+
+    def renderizar(self):
+        lineas = [f"# HELP {self.nombre} {self.descripcion}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            for clave, (cubetas, suma, cuenta) in sorted(self._series.items()):
+                for limite, cantidad in zip(self.limites, cubetas):
+                    lineas.append(f"{self.nombre}_bucket{_formatear_etiquetas(clave + (('le', limite),))} {cantidad}")
+                lineas.append(f"{self.nombre}_bucket{_formatear_etiquetas(clave + (('le', '+Inf'),))} {cuenta}")
+                lineas.append(f"{self.nombre}_sum{_formatear_etiquetas(clave)} {suma}")
+                lineas.append(f"{self.nombre}_count{_formatear_etiquetas(clave)} {cuenta}")
+        return "\n".join(lineas)
+
+
+histograma_peticiones = Histograma("srat_peticion_segundos", "Duración total de cada mensaje por endpoint y tipo de consulta")
+histograma_etapas = Histograma("srat_etapa_segundos", "Duración de cada etapa: router, agente, llm, herramienta, sql, correo")
+contador_tokens = Contador("srat_llm_tokens_total", "Tokens consumidos por las llamadas al LLM")
+histograma_similitud = Histograma(
+    "srat_cache_semantica_similitud",
+    "Similitud con la pregunta más cercana de la caché semántica en cada búsqueda",
+    limites=LIMITES_SIMILITUD,
+)
+METRICAS = [histograma_peticiones, histograma_etapas, contador_tokens, histograma_similitud]
+
+
+@contextmanager
+def medir(etapa, **etiquetas):
+    """Mide la duración de una etapa, la registra en el histograma y en el log (DEBUG)"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        histograma_etapas.observar(duracion, etapa=etapa, **etiquetas)
+        logger.debug("etapa=%s duracion_ms=%.1f %s", etapa, duracion * 1000, etiquetas)
+
+
+def _contar_tokens(respuesta):
+    """(entrada, salida) de un LLMResult, según lo que informe el proveedor"""
+    entrada = salida = 0
+    for generaciones in respuesta.generations:
+        for generacion in generaciones:
+            uso = getattr(getattr(generacion, "message", None), "usage_metadata", None)
+            if uso:
+                entrada += uso.get("input_tokens", 0)
+                salida += uso.get("output_tokens", 0)
+    if not entrada and not salida:
+        uso = (respuesta.llm_output or {}).get("token_usage") or {}
+        entrada, salida = uso.get("prompt_tokens", 0), uso.get("completion_tokens", 0)
+    return entrada, salida
+
+
+class InstrumentacionLLM(BaseCallbackHandler):
+    """
+    Callback que mide cada llamada al LLM (con sus tokens) y cada llamada a
+    herramienta de una ejecución. Se crea uno por invocación con sus etiquetas.
+    """
+
+    def __init__(self, origen, tipo_consulta=""):
+        self.origen = origen
+        self.tipo_consulta = tipo_consulta
+        self._inicios = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._inicios[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._inicios[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        inicio = self._inicios.pop(run_id, None)
+        if inicio is not None:
+            histograma_etapas.observar(time.perf_counter() - inicio, etapa="llm",
+                                       origen=self.origen, tipo_consulta=self.tipo_consulta)
+        entrada, salida = _contar_tokens(response)
+        contador_tokens.incrementar(entrada, tipo="entrada", origen=self.origen, tipo_consulta=self.tipo_consulta)
+        contador_tokens.incrementar(salida, tipo="salida", origen=self.origen, tipo_consulta=self.tipo_consulta)
+        logger.debug("llm origen=%s tipo_consulta=%s tokens_entrada=%d tokens_salida=%d",
+                     self.origen, self.tipo_consulta, entrada, salida)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._inicios.pop(run_id, None)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._inicios[run_id] = (time.perf_counter(), (serialized or {}).get("name", ""))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._registrar_herramienta(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._registrar_herramienta(run_id)
+
+    def _registrar_herramienta(self, run_id):
+        inicio = self._inicios.pop(run_id, None)
+        if inicio is not None:
+            histograma_etapas.observar(time.perf_counter() - inicio[0], etapa="herramienta",
+                                       herramienta=inicio[1], tipo_consulta=self.tipo_consulta)
+
+
+def instrumentar_sql(engine):
+    """Registra la duración de cada consulta SQL como etapa 'sql'"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def antes(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("inicios_consulta", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def despues(conn, cursor, statement, parameters, context, executemany):
+        inicios = conn.info.get("inicios_consulta")
+        if inicios:  # consultas que ya estaban en curso al registrar los eventos no tienen inicio
+            histograma_etapas.observar(time.perf_counter() - inicios.pop(), etapa="sql")
+
+
+def renderizar_estadisticas(estadisticas, prefijo="srat"):
+    """Exporta como gauges los valores numéricos de /estadisticas"""
+    lineas = []
+    for clave, valor in estadisticas.items():
+        nombre = f"{prefijo}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(clave)).lower()}"
+        if isinstance(valor, dict):
+            lineas += renderizar_estadisticas(valor, nombre)
+        elif isinstance(valor, (bool, int, float)):
+            lineas.append(f"# TYPE {nombre} gauge")
+            lineas.append(f"{nombre} {float(valor)}")
+    return lineas
+
+# =============================================================================
+# ARRANQUE - Inicialización diferida de los componentes pesados
+# =============================================================================
+
+class Perezoso:
+    """
+    Construye un componente pesado (cliente del LLM, Gmail, snapshot académico,
+    modelo de la caché semántica) recién cuando se
+    usa por primera vez o cuando lo prepara el precalentamiento. La fábrica
+    corre una sola vez aunque varios hilos lo pidan al mismo tiempo; si falla,
+    el error queda registrado y se reintenta en el próximo uso.
+    """
+
+    def __init__(self, nombre, fabrica):
+        self.nombre = nombre
+        self._fabrica = fabrica
+        self._valor = None
+        self._listo = False
+        self._lock = threading.Lock()
+        self._lock_segundo_plano = threading.Lock()
+        self.duracion = None
+        self.error = None
+        self._en_segundo_plano = False
+
+    def obtener(self):
+        if self._listo:
+            return self._valor
+        with self._lock:
+            if not self._listo:
+                inicio = time.perf_counter()
+                try:
+                    self._valor = self._fabrica()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.duracion = time.perf_counter() - inicio
+                self.error = None
+                self._listo = True
+                logger.info("%s inicializado en %.0fms", self.nombre, self.duracion * 1000)
+        return self._valor
+
+    def obtener_sin_esperar(self):
+        """
+        El componente si ya está construido; si no, retorna None enseguida y
+        lanza la construcción en segundo plano (una sola a la vez).
+        """
+        if self._listo:
+            return self._valor
+        with self._lock_segundo_plano:
+            if self._en_segundo_plano:
+                return None
+            self._en_segundo_plano = True
+        threading.Thread(target=self._construir_en_segundo_plano, daemon=True, name=f"inicio-{self.nombre}").start()
+        return None
+
+    def _construir_en_segundo_plano(self):
+        try:
+            self.obtener()
+        except Exception as e:
+            logger.error("Error inicializando %s: %s", self.nombre, e)
+        finally:
+            with self._lock_segundo_plano:
+                self._en_segundo_plano = False
+
+    def establecer(self, valor):
+        """Reemplaza el componente por uno ya construido (p. ej. un modelo falso)"""
+        with self._lock:
+            self._valor = valor
+            self._listo = True
+            self.error = None
+
+    @property
+    def listo(self):
+        return self._listo
+
+    def estado(self):
+        return {
+            "listo": self._listo,
+            "duracion_ms": round(self.duracion * 1000, 1) if self.duracion is not None else None,
+            "error": self.error,
+        }
+
+
+# Componentes que informa /readyz
+COMPONENTES = {}
+
+
+def perezoso(nombre, fabrica):
+    componente = Perezoso(nombre, fabrica)
+    COMPONENTES[nombre] = componente
+    return componente
+
+# =============================================================================
+# LLM - Límite global de llamadas simultáneas
+# =============================================================================
+
+class ServicioOcupado(Exception):
+    """No hay capacidad para atender la llamada al LLM en un tiempo razonable"""
+
+    def __init__(self, reintentar_en):
+        super().__init__(f"LLM saturado, reintentar en {reintentar_en}s")
+        self.reintentar_en = reintentar_en
+
+
+class CubetaTokens:
+    """
+    Cubeta de tokens que se repone de forma continua a razón de `por_minuto`
+    hasta `capacidad` (por defecto, lo de un minuto). Las reservas pueden dejarla
+    en negativo: la espera es lo que tarda en reponerse.
+    No es segura entre hilos por sí sola (la protege LimitadorLLM).
+    """
+
+    def __init__(self, por_minuto, capacidad=None):
+        self.por_minuto = por_minuto
+        self.capacidad = capacidad or por_minuto
+        self._disponibles = float(self.capacidad)
+        self._actualizada = time.monotonic()
+
+    def _reponer(self):
+        ahora = time.monotonic()
+        self._disponibles = min(self.capacidad,
+                                self._disponibles + (ahora - self._actualizada) * self.por_minuto / 60)
+        self._actualizada = ahora
+
+    def espera_para(self, cantidad=0):
+        """Segundos hasta que la cubeta tenga saldo para `cantidad`"""
+        self._reponer()
+        return max(0.0, (min(cantidad, self.capacidad) - self._disponibles) * 60 / self.por_minuto)
+
+    def reservar(self, cantidad):
+        """Descuenta `cantidad` y devuelve los segundos a esperar para respetar el límite"""
+        espera = self.espera_para(cantidad)
+        self._disponibles -= min(cantidad, self.capacidad)
+        return espera
+
+    def devolver(self, cantidad):
+        self._reponer()
+        self._disponibles = min(self.capacidad, self._disponibles + cantidad)
+
+    def disponibles(self):
+        self._reponer()
+        return self._disponibles
+
+
+class LimitadorLLM:
+    """
+    Controla todas las llamadas al LLM: pedidos y tokens por minuto (cubetas de
+    tokens), llamadas simultáneas y una cola de espera acotada. Cuando la cola
+    está llena o la espera superaría espera_max_segundos rechaza enseguida con
+    ServicioOcupado, en lugar de acumular pedidos que igual fallarían.
+    """
+
+    def __init__(self, max_concurrentes, rpm=0, tpm=0, cola_max=32, espera_max_segundos=20):
+        self.max_concurrentes = max_concurrentes
+        self.cola_max = cola_max
+        self.espera_max_segundos = espera_max_segundos
+        self._semaforo = threading.BoundedSemaphore(max_concurrentes)
+        self._lock = threading.Lock()
+        self._rpm = CubetaTokens(rpm) if rpm else None
+        self._tpm = CubetaTokens(tpm) if tpm else None
+        self._pausa_hasta = 0.0
+        self.en_curso = 0
+        self.esperando = 0
+        self.limitadas = 0
+        self.rechazadas = 0
+        self.reintentos = 0
+
+    def _espera_estimada(self):
+        espera = max(0.0, self._pausa_hasta - time.monotonic())
+        if self._rpm is not None:
+            espera = max(espera, self._rpm.espera_para(1))
+        if self._tpm is not None:
+            espera = max(espera, self._tpm.espera_para())
+        return espera
+
+    def _devolver(self, tokens):
+        if self._rpm is not None:
+            self._rpm.devolver(1)
+        if self._tpm is not None:
+            self._tpm.devolver(tokens)
+
+    @contextmanager
+    def turno(self, tokens_estimados=0):
+        with self._lock:
+            if self.esperando >= self.cola_max:
+                self.rechazadas += 1
+                raise ServicioOcupado(max(1, math.ceil(self._espera_estimada())))
+            espera = max(0.0, self._pausa_hasta - time.monotonic())
+            if self._rpm is not None:
+                espera = max(espera, self._rpm.reservar(1))
+            if self._tpm is not None:
+                espera = max(espera, self._tpm.reservar(tokens_estimados))
+            if espera > self.espera_max_segundos:
+                self._devolver(tokens_estimados)
+                self.rechazadas += 1
+                raise ServicioOcupado(math.ceil(espera))
+            if espera > 0:
+                self.limitadas += 1
+            self.esperando += 1
+        limite = time.monotonic() + self.espera_max_segundos
+        try:
+            if espera > 0:
+                time.sleep(espera)
+            obtenido = self._semaforo.acquire(timeout=max(0.0, limite - time.monotonic()))
+        finally:
+            with self._lock:
+                self.esperando -= 1
+        if not obtenido:
+            with self._lock:
+                self._devolver(tokens_estimados)
+                self.rechazadas += 1
+            raise ServicioOcupado(max(1, math.ceil(self.espera_max_segundos / 2)))
+        with self._lock:
+            self.en_curso += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.en_curso -= 1
+            self._semaforo.release()
+
+    def ajustar_tokens(self, estimados, reales):
+        """Corrige la reserva de tokens con el consumo informado por el proveedor"""
+        if self._tpm is None or not reales:
+            return
+        with self._lock:
+            if reales > estimados:
+                self._tpm.reservar(reales - estimados)
+            else:
+                self._tpm.devolver(estimados - reales)
+
+    def esperar_reintento(self, error, intento, backoff_segundos):
+        """
+        Ante un 429 pausa todas las llamadas: lo que indique Retry-After o un
+        backoff exponencial, con variación aleatoria para no reintentar todas juntas
+        """
+        respuesta = getattr(error, "response", None)
+        try:
+            espera = float(respuesta.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            espera = backoff_segundos * 2 ** intento
+        espera *= random.uniform(0.8, 1.5)
+        with self._lock:
+            self.reintentos += 1
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + espera)
+        logger.warning("LLM: límite del proveedor (429), reintento %d en %.1fs", intento + 1, espera)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "max_concurrentes": self.max_concurrentes,
+                "en_curso": self.en_curso,
+                "esperando": self.esperando,
+                "cola_max": self.cola_max,
+                "limitadas": self.limitadas,
+                "rechazadas_ocupado": self.rechazadas,
+                "reintentos_429": self.reintentos,
+                "pedidos_disponibles": round(self._rpm.disponibles(), 1) if self._rpm else None,
+                "tokens_disponibles": round(self._tpm.disponibles()) if self._tpm else None,
+            }
+
+
+limitador_llm = LimitadorLLM(
+    app.config['LLM_MAX_CONCURRENTES'],
+    rpm=app.config['LLM_RPM'],
+    tpm=app.config['LLM_TPM'],
+    cola_max=app.config['LLM_COLA_MAX'],
+    espera_max_segundos=app.config['LLM_ESPERA_MAX_SEGUNDOS'],
+)
+
+
+def _tokens_resultado(resultado):
+    """Tokens totales informados en un ChatResult (0 si el proveedor no los informa)"""
+    total = 0
+    for generacion in resultado.generations:
+        uso = getattr(generacion.message, "usage_metadata", None)
+        if uso:
+            total += uso.get("total_tokens", 0)
+    return total or ((resultado.llm_output or {}).get("token_usage") or {}).get("total_tokens", 0)
+
+
+class ChatGroqLimitado(ChatGroq):
+    """
+    ChatGroq que pasa por el limitador global (también dentro de los agentes) y
+    reintenta los 429 del proveedor con backoff. Los reintentos propios del
+    cliente de Groq se desactivan para no esperar dos veces.
+    """
+
+    max_retries: int = 0
+
+    def _tokens_estimados(self, messages):
+        return contar_tokens_aproximados(messages) + (self.max_tokens or 256)
+
+    def _generate(self, messages, *args, **kwargs):
+        estimados = self._tokens_estimados(messages)
+        intento = 0
+        while True:
+            try:
+                with limitador_llm.turno(estimados):
+                    resultado = super()._generate(messages, *args, **kwargs)
+            except groq.RateLimitError as e:
+                if intento >= app.config['LLM_REINTENTOS']:
+                    raise
+                limitador_llm.esperar_reintento(e, intento, app.config['LLM_BACKOFF_SEGUNDOS'])
+                intento += 1
+                continue
+            limitador_llm.ajustar_tokens(estimados, _tokens_resultado(resultado))
+            return resultado
+
+    def _stream(self, messages, *args, **kwargs):
+        estimados = self._tokens_estimados(messages)
+        intento = 0
+        while True:
+            reales = 0
+            emitido = False
+            try:
+                with limitador_llm.turno(estimados):
+                    for chunk in super()._stream(messages, *args, **kwargs):
+                        uso = getattr(chunk.message, "usage_metadata", None)
+                        if uso:
+                            reales += uso.get("total_tokens", 0)
+                        emitido = True
+                        yield chunk
+            except groq.RateLimitError as e:
+                # Solo se reintenta si todavía no se entregó ningún fragmento
+                if emitido or intento >= app.config['LLM_REINTENTOS']:
+                    raise
+                limitador_llm.esperar_reintento(e, intento, app.config['LLM_BACKOFF_SEGUNDOS'])
+                intento += 1
+                continue
+            limitador_llm.ajustar_tokens(estimados, reales)
+            return
+
+
+# LLM de los agentes (se crea en el primer uso o en el precalentamiento)
+componente_llm = perezoso("llm", lambda: ChatGroqLimitado(model_name='llama-3.3-70b-versatile'))
+
+
+def crear_toolkit_gmail():
+    """
+    GmailToolkit con las credenciales de token.json/credentials.json. Puede
+    bloquear en el flujo OAuth la primera vez, por eso no se crea al importar.
+    """
+    if app.config['GMAIL_BACKEND'] == 'falso':
+        return None
+    with medir_importacion("langchain_google_community"):
+        from langchain_google_community import GmailToolkit
+        from langchain_google_community.gmail.utils import build_resource_service, get_gmail_credentials
+    try:
+        token_path = os.path.join(script_dir, "token.json")
+        credentials_path = os.path.join(script_dir, "credentials.json")
+        
+        credentials = get_gmail_credentials(
+            token_file=token_path,
+            scopes=["https://mail.google.com/"],
+            client_secrets_file=credentials_path,
+        )
+        api_resource = build_resource_service(credentials=credentials)
+        return GmailToolkit(api_resource=api_resource)
+    except Exception as e:
+        logger.error("Error GmailToolkit: %s", e)
+        return GmailToolkit()
+
 
 # GmailToolkit
-try:
-    # Obtener la ruta del directorio actual del script
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    token_path = os.path.join(script_dir, "token.json")
-    credentials_path = os.path.join(script_dir, "credentials.json")
-    
-    credentials = get_gmail_credentials(
-        token_file=token_path,
-        scopes=["https://mail.google.com/"],
-        client_secrets_file=credentials_path,
-    )
-    api_resource = build_resource_service(credentials=credentials)
-    toolkit = GmailToolkit(api_resource=api_resource)
-except Exception as e:
-    print(f"Error GmailToolkit: {str(e)}")
-    toolkit = GmailToolkit()
+componente_gmail = perezoso("gmail", crear_toolkit_gmail)
+
+# =============================================================================
+# CACHÉS
+# =============================================================================
+
+_AUSENTE = object()
+
+
+class CacheTTL:
+    """Caché LRU con expiración por tiempo y contadores de aciertos/fallos"""
+
+    def __init__(self, max_entradas, ttl_segundos):
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave, defecto=None):
+        with self._lock:
+            entrada = self._datos.get(clave, _AUSENTE)
+            if entrada is not _AUSENTE and entrada[1] < time.time():
+                del self._datos[clave]
+                entrada = _AUSENTE
+            if entrada is _AUSENTE:
+                self.fallos += 1
+                return defecto
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def guardar(self, clave, valor):
+        self._guardar_en_memoria(clave, valor, time.time() + self.ttl_segundos)
+
+    def _guardar_en_memoria(self, clave, valor, vence):
+        with self._lock:
+            self._datos[clave] = (valor, vence)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._datos),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else 0.0,
+            }
+
+
+class CacheClasificacion(CacheTTL):
+    """
+    Caché de clasificaciones del router, opcionalmente persistida en un archivo
+    SQLite para sobrevivir a reinicios del servidor.
+    """
+
+    def __init__(self, max_entradas, ttl_segundos, ruta_sqlite=None):
+        super().__init__(max_entradas, ttl_segundos)
+        self._conexion = None
+        self._lock_sqlite = threading.Lock()
+        if ruta_sqlite:
+            try:
+                self._conexion = sqlite3.connect(ruta_sqlite, check_same_thread=False)
+                self._conexion.execute(
+                    "CREATE TABLE IF NOT EXISTS router_cache ("
+                    "clave TEXT PRIMARY KEY, tipo TEXT NOT NULL, vence REAL NOT NULL)"
+                )
+                self._conexion.execute("DELETE FROM router_cache WHERE vence < ?", (time.time(),))
+                self._conexion.commit()
+                filas = self._conexion.execute(
+                    "SELECT clave, tipo, vence FROM router_cache ORDER BY vence DESC LIMIT ?",
+                    (max_entradas,),
+                ).fetchall()
+                for clave, tipo, vence in reversed(filas):
+                    self._guardar_en_memoria(clave, tipo, vence)
+            except sqlite3.Error as e:
+                logger.error("Error caché del router en %s: %s", ruta_sqlite, e)
+                self._conexion = None
+
+    @staticmethod
+    def clave(mensaje, tipo_consulta_actual):
+        return f"{tipo_consulta_actual}|{normalizar_texto(mensaje)}"
+
+    def guardar(self, clave, valor):
+        vence = time.time() + self.ttl_segundos
+        self._guardar_en_memoria(clave, valor, vence)
+        if self._conexion is None:
+            return
+        try:
+            with self._lock_sqlite:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO router_cache (clave, tipo, vence) VALUES (?, ?, ?)",
+                    (clave, valor, vence),
+                )
+                self._conexion.commit()
+        except sqlite3.Error as e:
+            logger.warning("Error guardando en caché del router: %s", e)
+
+    def estadisticas(self):
+        estadisticas = super().estadisticas()
+        estadisticas["persistente"] = self._conexion is not None
+        return estadisticas
+
+
+# Datos personales en preguntas o respuestas: legajos/DNI/teléfonos y correos.
+# En las preguntas además se descartan las presentaciones ("me llamo", "soy ...")
+PATRON_DATOS_PERSONALES = re.compile(r"\d{4,}|[\w.+-]+@[\w-]+\.[\w.-]+")
+PATRON_PRESENTACION = re.compile(
+    r"\bme llamo\b|\bmi nombre\b|\bsoy\b|\bmi (?:legajo|correo|email|mail|dni)\b", re.IGNORECASE
+)
+PALABRAS_VACIAS = frozenset(
+    "a al como con de del el en es esta la las le lo los me mi o para por que se si su te tu un una y ya yo".split()
+)
+
+
+# Las negaciones no son palabras vacías: "no puedo ingresar" y "ya puedo ingresar" piden cosas
+# opuestas. Además la caché solo compara preguntas con la misma polaridad
+NEGACIONES = frozenset("no ni nunca tampoco jamas".split())
+
+
+def tiene_negacion(texto):
+    return not NEGACIONES.isdisjoint(re.findall(r"[a-z]+", normalizar_texto(texto)))
+
+
+def tokenizar(texto):
+    """Palabras normalizadas sin tildes ni palabras vacías"""
+    return [p for p in re.findall(r"[a-z0-9]+", normalizar_texto(texto)) if p not in PALABRAS_VACIAS]
+
+
+class VectorizadorTFIDF:
+    """
+    Representa cada pregunta por la frecuencia de sus palabras y compara con
+    coseno ponderado por IDF. El IDF se calcula sobre las preguntas guardadas.
+    """
+
+    nombre = "tfidf"
+    umbral_por_defecto = 0.8
+
+    def __init__(self):
+        self._frecuencia_documentos = Counter()
+        self._documentos = 0
+
+    def representar(self, texto):
+        return Counter(tokenizar(texto))
+
+    def registrar(self, representacion, signo=1):
+        """Actualiza el IDF al guardar (signo=1) o descartar (signo=-1) una pregunta"""
+        self._documentos += signo
+        for termino in representacion:
+            self._frecuencia_documentos[termino] += signo
+            if self._frecuencia_documentos[termino] <= 0:
+                del self._frecuencia_documentos[termino]
+
+    def _pesos(self, representacion):
+        pesos = {
+            termino: cantidad * (math.log((1 + self._documentos) / (1 + self._frecuencia_documentos[termino])) + 1)
+            for termino, cantidad in representacion.items()
+        }
+        norma = math.sqrt(sum(p * p for p in pesos.values())) or 1.0
+        return {termino: p / norma for termino, p in pesos.items()}
+
+    def similitudes(self, consulta, representaciones):
+        pesos_consulta = self._pesos(consulta)
+        resultado = []
+        for representacion in representaciones:
+            pesos = self._pesos(representacion)
+            resultado.append(sum(p * pesos.get(termino, 0.0) for termino, p in pesos_consulta.items()))
+        return resultado
+
+
+class VectorizadorEmbeddings:
+    """Embeddings de un modelo local de sentence-transformers (solo CPU)"""
+
+    umbral_por_defecto = 0.88
+
+    def __init__(self, modelo):
+        from sentence_transformers import SentenceTransformer
+        self.nombre = f"embeddings:{modelo}"
+        self._modelo = SentenceTransformer(modelo, device="cpu")
+
+    def representar(self, texto):
+        return self._modelo.encode(normalizar_texto(texto), normalize_embeddings=True)
+
+    def registrar(self, representacion, signo=1):
+        pass
+
+    def similitudes(self, consulta, representaciones):
+        # Vectores normalizados: el producto escalar es el coseno
+        return [float(consulta @ representacion) for representacion in representaciones]
+
+
+def crear_vectorizador(modelo):
+    """Usa el modelo de embeddings si está configurado e instalado; si no, TF-IDF"""
+    if modelo:
+        try:
+            return VectorizadorEmbeddings(modelo)
+        except Exception as e:
+            logger.warning("No se pudo cargar el modelo de embeddings %s, se usa TF-IDF: %s", modelo, e)
+    return VectorizadorTFIDF()
+
+
+class CacheSemantica:
+    """
+    Respuestas ya dadas a preguntas frecuentes, buscadas por vecino más cercano.
+    Solo acepta pares pregunta/respuesta sin datos personales.
+    """
+
+    def __init__(self, vectorizador, umbral=None, max_entradas=500, ttl_segundos=86400):
+        self.vectorizador = vectorizador
+        self.umbral = umbral if umbral is not None else vectorizador.umbral_por_defecto
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        # pregunta normalizada -> (representación, respuesta, vence)
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.rechazadas = 0
+
+    @staticmethod
+    def contiene_datos_personales(texto, es_pregunta=False):
+        if PATRON_DATOS_PERSONALES.search(texto):
+            return True
+        return es_pregunta and bool(PATRON_PRESENTACION.search(texto))
+
+    def _quitar(self, clave):
+        representacion, _respuesta, _vence = self._entradas.pop(clave)
+        self.vectorizador.registrar(representacion, signo=-1)
+
+    def buscar(self, pregunta):
+        """Retorna la respuesta guardada más parecida si supera el umbral, o None"""
+        if self.contiene_datos_personales(pregunta, es_pregunta=True):
+            return None
+        consulta = self.vectorizador.representar(pregunta)
+        with self._lock:
+            ahora = time.time()
+            for clave in [c for c, (_r, _t, vence) in self._entradas.items() if vence < ahora]:
+                self._quitar(clave)
+            mejor_clave, mejor_similitud = None, 0.0
+            negada = tiene_negacion(pregunta)
+            claves = [c for c in self._entradas if tiene_negacion(c) == negada]
+            if claves:
+                similitudes = self.vectorizador.similitudes(consulta, [self._entradas[c][0] for c in claves])
+                mejor_similitud, mejor_clave = max(zip(similitudes, claves), key=lambda par: par[0])
+                histograma_similitud.observar(min(mejor_similitud, 1.0), vectorizador=self.vectorizador.nombre)
+            if mejor_clave is None or mejor_similitud < self.umbral:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            self._entradas.move_to_end(mejor_clave)
+            logger.debug("Caché semántica: acierto %.3f para %r ~ %r", mejor_similitud, pregunta, mejor_clave)
+            return self._entradas[mejor_clave][1]
+
+    def guardar(self, pregunta, respuesta):
+        """Guarda el par si ninguno contiene datos personales. Retorna si se guardó"""
+        if not respuesta or self.contiene_datos_personales(pregunta, es_pregunta=True) \
+                or self.contiene_datos_personales(respuesta):
+            with self._lock:
+                self.rechazadas += 1
+            return False
+        representacion = self.vectorizador.representar(pregunta)
+        clave = normalizar_texto(pregunta)
+        with self._lock:
+            if clave in self._entradas:
+                self._quitar(clave)
+            self._entradas[clave] = (representacion, respuesta, time.time() + self.ttl_segundos)
+            self.vectorizador.registrar(representacion)
+            while len(self._entradas) > self.max_entradas:
+                self._quitar(next(iter(self._entradas)))
+        return True
+
+    def limpiar(self):
+        with self._lock:
+            for clave in list(self._entradas):
+                self._quitar(clave)
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                "vectorizador": self.vectorizador.nombre,
+                "umbral": self.umbral,
+                "entradas": len(self._entradas),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "rechazadas": self.rechazadas,
+                "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else 0.0,
+            }
+
+class LlamadasEnCurso:
+    """
+    Agrupa llamadas idénticas simultáneas: la primera con una clave ejecuta la
+    función y las que llegan mientras tanto esperan y reciben el mismo resultado
+    (o la misma excepción).
+    """
+
+    def __init__(self):
+        self._en_curso = {}
+        self._lock = threading.Lock()
+        self.agrupadas = 0
+
+    def ejecutar(self, clave, funcion):
+        """Retorna (resultado, agrupada); agrupada es True si se reutilizó otra llamada"""
+        with self._lock:
+            futuro = self._en_curso.get(clave)
+            agrupada = futuro is not None
+            if agrupada:
+                self.agrupadas += 1
+            else:
+                futuro = self._en_curso[clave] = Future()
+        if agrupada:
+            return futuro.result(), True
+        try:
+            resultado = funcion()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            futuro.set_result(resultado)
+            return resultado, False
+        finally:
+            with self._lock:
+                del self._en_curso[clave]
+
+    def en_curso(self):
+        with self._lock:
+            return len(self._en_curso)
 
 # =============================================================================
 # HERRAMIENTAS
 # =============================================================================
 
+# Consulta única: email, materias y carreras de un legajo en un solo viaje a la BD.
+# Se usan LEFT JOIN para obtener el email aunque el usuario no tenga cargos.
+SQL_INFO_ACADEMICA = """
+SELECT u.legajo AS legajo, u.email AS email, am.nombre AS materia, ac.nombre AS carrera
+FROM usuarios u
+LEFT JOIN cargos c ON u.id = c.usuario_id
+LEFT JOIN asignaturas a ON a.id = c.asignatura_id
+LEFT JOIN asignaturas_materias am ON a.materia_id = am.id
+LEFT JOIN asignaturas_carreras ac ON a.carrera_id = ac.id
+"""
+QUERY_INFO_ACADEMICA = text(SQL_INFO_ACADEMICA + "WHERE u.legajo = :legajo")
+QUERY_SNAPSHOT_ACADEMICO = text(SQL_INFO_ACADEMICA)
+# Envío masivo: muchos legajos por consulta en lugar de una consulta por legajo
+QUERY_INFO_ACADEMICA_LOTE = text(SQL_INFO_ACADEMICA + "WHERE u.legajo IN :legajos").bindparams(
+    bindparam("legajos", expanding=True)
+)
+QUERY_LEGAJOS = text("SELECT legajo FROM usuarios ORDER BY legajo")
+
+
+class SnapshotAcademico:
+    """
+    Índice en memoria legajo -> (email, asignaturas) cargado con una sola
+    consulta. Los datos cambian a lo sumo una vez por cuatrimestre, así que las
+    búsquedas se resuelven sin ir a la base; ante un legajo ausente se vuelve a
+    la consulta en vivo.
+    """
+
+    def __init__(self):
+        self._indice = {}
+        self._lock = threading.Lock()
+        self.bytes_aproximados = 0
+        self.duracion_ultima_carga = None
+        self.cargado_en = None
+        self.cargas = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    def cargar(self):
+        """Recarga el índice completo; requiere contexto de aplicación"""
+        inicio = time.perf_counter()
+        with db.engine.connect() as conexion:
+            registros = conexion.execute(QUERY_SNAPSHOT_ACADEMICO)
+            indice = {}
+            for r in registros:
+                legajo = normalizar_legajo(r.legajo)
+                if legajo is None:
+                    continue
+                email, asignaturas = indice.setdefault(legajo, (str(r.email or ""), []))
+                if r.materia is not None:
+                    # Los nombres se repiten entre miles de legajos: se internan
+                    asignaturas.append((sys.intern(str(r.materia)), sys.intern(str(r.carrera))))
+        indice = {legajo: (email, tuple(asignaturas)) for legajo, (email, asignaturas) in indice.items()}
+
+        with self._lock:
+            self._indice = indice
+            self.bytes_aproximados = self._medir(indice)
+            self.duracion_ultima_carga = time.perf_counter() - inicio
+            self.cargado_en = time.time()
+            self.cargas += 1
+        logger.info("Snapshot académico: %d legajos en %.0fms (~%d KiB)",
+                    len(indice), self.duracion_ultima_carga * 1000, self.bytes_aproximados // 1024)
+
+    @staticmethod
+    def _medir(indice):
+        total = sys.getsizeof(indice)
+        nombres = set()
+        for legajo, (email, asignaturas) in indice.items():
+            total += sys.getsizeof(legajo) + sys.getsizeof(email) + sys.getsizeof(asignaturas)
+            for par in asignaturas:
+                total += sys.getsizeof(par)
+                nombres.update(par)
+        return total + sum(sys.getsizeof(nombre) for nombre in nombres)
+
+    def obtener(self, legajo):
+        entrada = self._indice.get(legajo)
+        if entrada is None:
+            self.fallos += 1
+            return None
+        self.aciertos += 1
+        email, asignaturas = entrada
+        return {"legajo": legajo, "email": email, "asignaturas": list(asignaturas)}
+
+    def iniciar(self, intervalo_segundos):
+        """Carga inicial y, si hay intervalo, refresco periódico en segundo plano"""
+        with app.app_context():
+            self.cargar()
+        if intervalo_segundos > 0:
+            threading.Thread(target=self._refrescar_periodicamente, args=(intervalo_segundos,),
+                             name="snapshot-academico", daemon=True).start()
+
+    def _refrescar_periodicamente(self, intervalo_segundos):
+        while True:
+            time.sleep(intervalo_segundos)
+            try:
+                with app.app_context():
+                    self.cargar()
+                invalidar_cache_legajo()
+            except Exception as e:
+                logger.error("Error refrescando snapshot académico: %s", e)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "legajos": len(self._indice),
+                "bytes_aproximados": self.bytes_aproximados,
+                "duracion_ultima_carga_ms": round(self.duracion_ultima_carga * 1000, 1) if self.duracion_ultima_carga else None,
+                "cargado_en": self.cargado_en,
+                "cargas": self.cargas,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+            }
+
+
+snapshot_academico = None
+componente_snapshot = None
+if app.config['SNAPSHOT_ACADEMICO']:
+    snapshot_academico = SnapshotAcademico()
+    # La carga completa la hace el precalentamiento (o la primera consulta, en segundo plano)
+    componente_snapshot = perezoso(
+        "snapshot_academico",
+        lambda: snapshot_academico.iniciar(app.config['SNAPSHOT_REFRESCO_SEGUNDOS']) or snapshot_academico,
+    )
+
+cache_legajos = CacheTTL(
+    max_entradas=app.config['LEGAJOS_CACHE_MAX'],
+    ttl_segundos=app.config['LEGAJOS_CACHE_TTL_SEGUNDOS'],
+)
+
+
+def normalizar_legajo(legajo):
+    """Convierte el legajo recibido (int o texto del agente) a entero, o None si no es válido"""
+    match = re.search(r"\d+", str(legajo))
+    return int(match.group(0)) if match else None
+
+
+def consultar_info_academica(legajo):
+    """
+    Obtiene email, materias y carreras de un legajo: primero del snapshot en
+    memoria (si está habilitado), luego de la caché por legajo y por último con
+    una sola consulta a la base. Retorna un diccionario con las claves
+    'legajo', 'email' y 'asignaturas' (lista de (materia, carrera)).
+    Los errores de base de datos se propagan y no se guardan en caché.
+    """
+    legajo = normalizar_legajo(legajo)
+    snapshot = componente_snapshot.obtener_sin_esperar() if componente_snapshot is not None else None
+    if snapshot is not None:
+        info = snapshot.obtener(legajo)
+        if info is not None:
+            return info
+
+    info = cache_legajos.obtener(legajo)
+    if info is not None:
+        return info
+
+    logger.debug("Consultando legajo %s en la base de datos", legajo)
+    with db.engine.connect() as conexion:
+        registros = conexion.execute(QUERY_INFO_ACADEMICA, {'legajo': legajo}).fetchall()
+
+    email = next((str(r.email) for r in registros if r.email), "")
+    asignaturas = [(r.materia, r.carrera) for r in registros if r.materia is not None]
+    info = {"legajo": legajo, "email": email, "asignaturas": asignaturas}
+    cache_legajos.guardar(legajo, info)
+    return info
+
+
+def consultar_info_academica_lote(legajos):
+    """
+    Versión por conjuntos de consultar_info_academica: resuelve del snapshot los
+    legajos que estén cargados y el resto con una sola consulta
+    WHERE u.legajo IN (...). Retorna {legajo: info}; los legajos inexistentes no
+    aparecen. No llena la caché por legajo para no desplazar a los de las
+    sesiones activas. Requiere contexto de aplicación.
+    """
+    resultado, faltantes = {}, []
+    snapshot = componente_snapshot.obtener_sin_esperar() if componente_snapshot is not None else None
+    for legajo in legajos:
+        info = snapshot.obtener(legajo) if snapshot is not None else None
+        if info is not None:
+            resultado[legajo] = info
+        else:
+            faltantes.append(legajo)
+    if not faltantes:
+        return resultado
+
+    with db.engine.connect() as conexion:
+        registros = conexion.execute(QUERY_INFO_ACADEMICA_LOTE, {'legajos': faltantes}).fetchall()
+    for r in registros:
+        legajo = normalizar_legajo(r.legajo)
+        info = resultado.setdefault(legajo, {"legajo": legajo, "email": "", "asignaturas": []})
+        if r.email and not info["email"]:
+            info["email"] = str(r.email)
+        if r.materia is not None:
+            info["asignaturas"].append((r.materia, r.carrera))
+    return resultado
+
+
+def invalidar_cache_legajo(legajo=None):
+    """Invalida la caché de un legajo, o la de todos si no se indica ninguno"""
+    if legajo is None:
+        cache_legajos.limpiar()
+    else:
+        cache_legajos.invalidar(normalizar_legajo(legajo))
+
+
+def formatear_asignaturas(legajo, asignaturas):
+    """Texto con las materias y carreras de un legajo (chat, correos y envío masivo)"""
+    if not asignaturas:
+        return f"No se encontraron asignaturas para el usuario con legajo {legajo}."
+
+    salida = f"Asignaturas del usuario con legajo {legajo}:\n"
+    for materia, carrera in asignaturas:
+        salida += f"- Materia: {materia} - Carrera: {carrera}\n"
+    return salida
+
+def correo_info_academica(info):
+    """Correo con la información académica de un legajo (chat y envío masivo)"""
+    legajo = info["legajo"]
+    return {
+        "to": [info["email"]],
+        "subject": "Tu información académica",
+        "message": f"Legajo: {legajo}\n\n{formatear_asignaturas(legajo, info['asignaturas'])}",
+    }
+
 def consultar_usuario_asignaturas(legajo):
     """
-    Consulta las asignaturas y carreras de un usuario por su legajo directamente en la base de datos
+    Consulta las asignaturas y carreras de un usuario por su legajo
     """
     try:
-        print(f"[DEBUG] Intentando consultar legajo: {legajo}")
-        print(f"[DEBUG] URI de BD: {app.config['SQLALCHEMY_DATABASE_URI']}")
-        
-        # Consulta SQL para obtener materia y carrera de un usuario por legajo
-        query = text("""
-        SELECT am.nombre as materia, ac.nombre as carrera
-        FROM usuarios u 
-        JOIN cargos c ON u.id = c.usuario_id
-        JOIN asignaturas a ON a.id = c.asignatura_id
-        JOIN asignaturas_materias am ON a.materia_id = am.id
-        JOIN asignaturas_carreras ac ON a.carrera_id = ac.id
-        WHERE u.legajo = :legajo
-        """)
-        
-        print(f"[DEBUG] Ejecutando consulta SQL...")
-        result = db.session.execute(query, {'legajo': legajo})
-        registros = result.fetchall()
-        
-        print(f"[DEBUG] Registros encontrados: {len(registros)}")
-        
-        if not registros:
-            return f"No se encontraron asignaturas para el usuario con legajo {legajo}."
-        
-        salida = f"Asignaturas del usuario con legajo {legajo}:\n"
-        for r in registros:
-            salida += f"- Materia: {r.materia} - Carrera: {r.carrera}\n"
-        
-        return salida
+        info = consultar_info_academica(legajo)
+        return formatear_asignaturas(legajo, info["asignaturas"])
         
     except Exception as e:
-        print(f"[DEBUG] Error completo: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error consultando las asignaturas del legajo %s", legajo)
         return f"Error al consultar la base de datos: {str(e)}"
 
 def obtener_email_por_legajo(legajo):
     """Obtiene el email asociado a un legajo desde la base de datos."""
     try:
-        query = text(
-            """
-            SELECT email
-            FROM usuarios
-            WHERE legajo = :legajo
-            LIMIT 1
-            """
-        )
-        result = db.session.execute(query, {"legajo": legajo}).fetchone()
-        if not result or not result[0]:
-            return ""
-        return str(result[0])
+        return consultar_info_academica(legajo)["email"]
     except Exception as e:
         return ""
 
-def formatear_historial(historial):
-    """Formatear historial con formato HTML"""
+def formatear_historial(historial, resumen=""):
+    """Formatear historial con formato HTML (el resumen de los turnos anteriores va primero)"""
     texto = "<div style='font-family: sans-serif; font-size: 14px;'>"
+    if resumen:
+        resumen_html = resumen.strip().replace("\n", "<br>")
+        texto += f"<em>Resumen de la conversación anterior:</em><br>{resumen_html}<br><br>"
     for msg in historial.messages:
         role = "Usuario" if msg.type == "human" else "Asistente"
         contenido = msg.content.strip().replace("\n", "<br>")
@@ -117,16 +1339,532 @@ def formatear_historial(historial):
     return texto
 
 # =============================================================================
-# AGENTE ROUTER - Detecta el tipo de consulta
+# COLA DE CORREOS - Envío asíncrono con reintentos y spool persistente
 # =============================================================================
 
-def detectar_tipo_consulta(mensaje, tipo_consulta_actual):
+class BackendGmail:
+    """Envía correos con la herramienta send_gmail_message del GmailToolkit"""
+
+    def __init__(self, componente_toolkit):
+        self._componente_toolkit = componente_toolkit
+        self._send_tool = None
+
+    def enviar(self, to, subject, message, cc=None, bcc=None):
+        if self._send_tool is None:
+            toolkit = self._componente_toolkit.obtener()
+            self._send_tool = next((t for t in toolkit.get_tools() if t.name == "send_gmail_message"), None)
+        if self._send_tool is None:
+            raise RuntimeError("La herramienta send_gmail_message no está disponible")
+        datos = {"to": to, "subject": subject, "message": message}
+        if cc:
+            datos["cc"] = cc
+        if bcc:
+            datos["bcc"] = bcc
+        self._send_tool.invoke(datos)
+
+
+class BackendGmailFalso:
+    """Backend en memoria para probar sin conexión: guarda los correos 'enviados'"""
+
+    def __init__(self):
+        self.enviados = []
+        self._lock = threading.Lock()
+
+    def enviar(self, to, subject, message, cc=None, bcc=None):
+        with self._lock:
+            self.enviados.append({"to": to, "subject": subject, "message": message, "cc": cc, "bcc": bcc})
+
+
+class ColaCorreos:
     """
-    Detecta automáticamente el tipo de consulta basado en el mensaje del usuario.
-    Retorna: 'SRAT', 'DATABASE', o 'GENERAL'
+    Cola de correos salientes atendida por un pool de hilos. Cada correo se
+    guarda primero en un spool SQLite, así que los pendientes se reintentan al
+    reiniciar el servidor. Los envíos fallidos se reintentan con backoff
+    exponencial hasta max_intentos; luego quedan en estado 'fallido'.
+
+    El spool puede estar compartido con otro proceso (p. ej. el comando
+    envio-masivo corriendo junto al servidor): antes de enviar, cada correo se
+    reclama con un UPDATE condicional a estado 'enviando', y solo lo envía el
+    proceso que logró el reclamo.
+    """
+
+    # Un reclamo más viejo que esto es de un proceso que murió a mitad del envío
+    RECLAMO_VENCIDO_SEGUNDOS = 300
+
+    def __init__(self, backend, ruta_spool, workers, max_intentos, backoff_segundos):
+        self.backend = backend
+        self.max_intentos = max_intentos
+        self.backoff_segundos = backoff_segundos
+        self._cola = queue.Queue()
+        self._lock = threading.Lock()
+        self.enviados = 0
+        self.reintentos = 0
+        self.fallidos = 0
+
+        self._conexion = sqlite3.connect(ruta_spool, check_same_thread=False)
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS correos ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, datos TEXT NOT NULL, "
+            "estado TEXT NOT NULL DEFAULT 'pendiente', intentos INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT, creado REAL NOT NULL, reclamado REAL)"
+        )
+        columnas = {fila[1] for fila in self._conexion.execute("PRAGMA table_info(correos)")}
+        if 'reclamado' not in columnas:
+            self._conexion.execute("ALTER TABLE correos ADD COLUMN reclamado REAL")
+        # Liberar los reclamos vencidos; los recientes pueden ser de otro proceso vivo
+        liberados = self._conexion.execute(
+            "UPDATE correos SET estado = 'pendiente', reclamado = NULL "
+            "WHERE estado = 'enviando' AND (reclamado IS NULL OR reclamado < ?)",
+            (time.time() - self.RECLAMO_VENCIDO_SEGUNDOS,),
+        ).rowcount
+        self._conexion.commit()
+        if liberados:
+            logger.warning("Cola de correos: %d reclamos vencidos liberados", liberados)
+
+        # Recuperar los correos que quedaron pendientes antes del reinicio
+        pendientes = self._conexion.execute("SELECT id FROM correos WHERE estado = 'pendiente' ORDER BY id").fetchall()
+        for (correo_id,) in pendientes:
+            self._cola.put(correo_id)
+        if pendientes:
+            logger.info("Cola de correos: %d pendientes recuperados del spool", len(pendientes))
+
+        for i in range(workers):
+            threading.Thread(target=self._trabajar, name=f"correo-{i}", daemon=True).start()
+
+    def encolar(self, to, subject, message, cc=None, bcc=None):
+        """Guarda el correo en el spool y lo deja listo para envío. Retorna su id."""
+        datos = json.dumps({"to": to, "subject": subject, "message": message, "cc": cc, "bcc": bcc}, ensure_ascii=False)
+        with self._lock:
+            cursor = self._conexion.execute(
+                "INSERT INTO correos (datos, creado) VALUES (?, ?)", (datos, time.time())
+            )
+            self._conexion.commit()
+            correo_id = cursor.lastrowid
+        self._cola.put(correo_id)
+        return correo_id
+
+    def en_cola(self):
+        return self._cola.qsize()
+
+    def esperar(self):
+        """Bloquea hasta que la cola se vacía (los reintentos programados siguen en el spool)"""
+        self._cola.join()
+
+    def _trabajar(self):
+        while True:
+            correo_id = self._cola.get()
+            try:
+                self._enviar(correo_id)
+            except Exception:
+                # Un error del spool (p. ej. "database is locked") no debe terminar el worker;
+                # el correo sigue pendiente en el spool y se reintenta al reiniciar
+                logger.exception("Error procesando el correo %s", correo_id)
+            finally:
+                self._cola.task_done()
+
+    def _enviar(self, correo_id):
+        with self._lock:
+            # Reclamo atómico: si otro proceso ya lo tomó (o lo envió), rowcount es 0
+            reclamado = self._conexion.execute(
+                "UPDATE correos SET estado = 'enviando', reclamado = ? WHERE id = ? AND estado = 'pendiente'",
+                (time.time(), correo_id),
+            ).rowcount
+            self._conexion.commit()
+            if not reclamado:
+                return
+            fila = self._conexion.execute(
+                "SELECT datos, intentos FROM correos WHERE id = ?", (correo_id,)
+            ).fetchone()
+        datos, intentos = json.loads(fila[0]), fila[1] + 1
+        try:
+            with medir("correo"):
+                self.backend.enviar(**datos)
+        except Exception as e:
+            if intentos >= self.max_intentos:
+                estado = 'fallido'
+                logger.error("Correo %s descartado tras %d intentos: %s", correo_id, intentos, e)
+            else:
+                estado = 'pendiente'
+                espera = self.backoff_segundos * 2 ** (intentos - 1)
+                threading.Timer(espera, self._cola.put, args=(correo_id,)).start()
+            with self._lock:
+                if estado == 'fallido':
+                    self.fallidos += 1
+                else:
+                    self.reintentos += 1
+                self._conexion.execute(
+                    "UPDATE correos SET estado = ?, intentos = ?, error = ?, reclamado = NULL WHERE id = ?",
+                    (estado, intentos, str(e), correo_id),
+                )
+                self._conexion.commit()
+            return
+        with self._lock:
+            self.enviados += 1
+            self._conexion.execute("DELETE FROM correos WHERE id = ?", (correo_id,))
+            self._conexion.commit()
+
+    def estadisticas(self):
+        with self._lock:
+            por_estado = dict(self._conexion.execute(
+                "SELECT estado, COUNT(*) FROM correos GROUP BY estado"
+            ).fetchall())
+            contadores = {"enviados": self.enviados, "reintentos": self.reintentos, "fallidos": self.fallidos}
+        return {
+            "en_cola": self._cola.qsize(),
+            "pendientes": por_estado.get('pendiente', 0),
+            "enviando": por_estado.get('enviando', 0),
+            "fallidos_en_spool": por_estado.get('fallido', 0),
+            **contadores,
+        }
+
+
+if app.config['GMAIL_BACKEND'] == 'falso':
+    backend_correo = BackendGmailFalso()
+else:
+    backend_correo = BackendGmail(componente_gmail)
+
+cola_correos = ColaCorreos(
+    backend=backend_correo,
+    ruta_spool=app.config['CORREO_SPOOL'],
+    workers=app.config['CORREO_WORKERS'],
+    max_intentos=app.config['CORREO_MAX_INTENTOS'],
+    backoff_segundos=app.config['CORREO_BACKOFF_SEGUNDOS'],
+)
+
+
+def enviar_correo_encolado(message, to, subject, cc=None, bcc=None, config: RunnableConfig = None):
+    """
+    Encola un correo para que lo envíe la cola en segundo plano. En una
+    ejecución especulativa (config con 'correos_diferidos') solo se anota y se
+    encola si la ejecución se confirma.
+    """
+    diferidos = ((config or {}).get("configurable") or {}).get("correos_diferidos")
+    if diferidos is not None:
+        diferidos.append({"to": to, "subject": subject, "message": message, "cc": cc, "bcc": bcc})
+        return "Mensaje encolado para envío."
+    correo_id = cola_correos.encolar(to, subject, message, cc=cc, bcc=bcc)
+    return f"Mensaje encolado para envío (id {correo_id})."
+
+
+def crear_herramientas_gmail():
+    """
+    Herramientas de Gmail para los agentes: send_gmail_message es la versión
+    encolada (misma firma) y el resto son las del GmailToolkit
+    """
+    with medir_importacion("langchain_google_community"):
+        from langchain_google_community.gmail.send_message import SendMessageSchema
+    herramienta_envio_encolado = StructuredTool.from_function(
+        enviar_correo_encolado,
+        name="send_gmail_message",
+        description="Use this tool to send email messages. The input is the message, recipients",
+        args_schema=SendMessageSchema,
+    )
+    toolkit = componente_gmail.obtener()
+    herramientas = [herramienta_envio_encolado]
+    if toolkit is not None:
+        herramientas += [t for t in toolkit.get_tools() if t.name != "send_gmail_message"]
+    return herramientas
+
+
+# Se listan una sola vez y se comparten entre los agentes
+herramientas_gmail = Perezoso("herramientas_gmail", crear_herramientas_gmail)
+
+# Las ejecuciones especulativas pueden descartarse: solo reciben herramientas de
+# lectura y el envío encolado, que queda diferido hasta la confirmación
+# (create_gmail_draft, por ejemplo, tendría efecto aunque se descarten)
+HERRAMIENTAS_GMAIL_ESPECULATIVAS = frozenset({
+    "send_gmail_message", "search_gmail", "get_gmail_message", "get_gmail_thread",
+})
+
+
+def obtener_herramientas_gmail(especulativo=False):
+    herramientas = herramientas_gmail.obtener()
+    if especulativo:
+        return [t for t in herramientas if t.name in HERRAMIENTAS_GMAIL_ESPECULATIVAS]
+    return herramientas
+
+# =============================================================================
+# ENVÍO MASIVO - Información académica por correo a muchos legajos
+# =============================================================================
+
+class EnvioMasivo:
+    """
+    Envía a cada legajo de un lote su información académica por correo. Los
+    datos se leen por bloques con una consulta por conjunto, los correos se
+    entregan a la cola (que los envía en paralelo con sus workers y reintentos)
+    a un ritmo máximo por minuto, y el progreso de cada legajo queda en el
+    spool: al repetir un lote se saltean los legajos ya resueltos. Los legajos
+    sin email o sin asignaturas no reciben correo. En modo simulación solo se
+    arman los mensajes (se cuentan como 'simulados'), sin encolar ni registrar
+    progreso.
+    """
+
+    def __init__(self, cola, ruta_spool, por_minuto, rafaga, tamano_bloque):
+        self.cola = cola
+        self.por_minuto = por_minuto
+        self.rafaga = max(1, rafaga)
+        self.tamano_bloque = tamano_bloque
+        self._lote_en_curso = {}
+        self._lock = threading.Lock()
+
+        self._conexion = sqlite3.connect(ruta_spool, check_same_thread=False)
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS envios_masivos ("
+            "lote TEXT NOT NULL, legajo INTEGER NOT NULL, estado TEXT NOT NULL, "
+            "correo_id INTEGER, actualizado REAL NOT NULL, PRIMARY KEY (lote, legajo))"
+        )
+        self._conexion.commit()
+
+    @staticmethod
+    def nuevo_lote():
+        return time.strftime("%Y%m%d-%H%M%S")
+
+    def ejecutar(self, lote, legajos=None, simulacion=False):
+        """
+        Procesa el lote en el hilo actual (legajos=None: todos los de la base) y
+        retorna el resumen. Requiere contexto de aplicación.
+        """
+        progreso = self._registrar(lote, simulacion)
+        self._procesar(progreso, legajos)
+        return self.estado(lote)
+
+    def iniciar(self, lote, legajos=None, simulacion=False):
+        """Procesa el lote en un hilo en segundo plano; se consulta con estado(lote)"""
+        progreso = self._registrar(lote, simulacion)
+        threading.Thread(target=self._procesar_en_segundo_plano, args=(progreso, legajos),
+                         name=f"envio-masivo-{lote}", daemon=True).start()
+
+    def _registrar(self, lote, simulacion):
+        with self._lock:
+            anterior = self._lote_en_curso.get(lote)
+            if anterior is not None and anterior["fin"] is None:
+                raise ValueError(f"El lote {lote} ya está en curso")
+            progreso = {
+                "lote": lote, "simulacion": simulacion, "total": 0, "salteados": 0,
+                "encolados": 0, "simulados": 0, "sin_email": 0, "sin_asignaturas": 0,
+                "inexistentes": 0, "errores": 0,
+                "inicio": time.time(), "fin": None, "error": None, "muestras": [],
+            }
+            self._lote_en_curso[lote] = progreso
+            return progreso
+
+    def _procesar_en_segundo_plano(self, progreso, legajos):
+        try:
+            with app.app_context():
+                self._procesar(progreso, legajos)
+        except Exception:
+            logger.exception("Error en el envío masivo %s", progreso["lote"])
+
+    def _procesar(self, progreso, legajos):
+        lote, simulacion = progreso["lote"], progreso["simulacion"]
+        try:
+            if legajos is None:
+                with db.engine.connect() as conexion:
+                    legajos = [r.legajo for r in conexion.execute(QUERY_LEGAJOS)]
+            legajos = list(dict.fromkeys(l for l in map(normalizar_legajo, legajos) if l is not None))
+            with self._lock:
+                resueltos = {legajo for (legajo,) in self._conexion.execute(
+                    "SELECT legajo FROM envios_masivos WHERE lote = ?", (lote,)
+                )}
+            pendientes = [legajo for legajo in legajos if legajo not in resueltos]
+            progreso.update(total=len(legajos), salteados=len(legajos) - len(pendientes))
+            logger.info("Envío masivo %s: %d legajos (%d ya resueltos)%s", lote, len(legajos),
+                        progreso["salteados"], " [simulación]" if simulacion else "")
+
+            cubeta = None
+            if self.por_minuto > 0 and not simulacion:
+                cubeta = CubetaTokens(self.por_minuto, capacidad=self.rafaga)
+            for i in range(0, len(pendientes), self.tamano_bloque):
+                bloque = pendientes[i:i + self.tamano_bloque]
+                with medir("envio_masivo"):
+                    infos = consultar_info_academica_lote(bloque)
+                for legajo in bloque:
+                    self._procesar_legajo(progreso, legajo, infos.get(legajo), cubeta)
+                logger.info("Envío masivo %s: %d/%d legajos", lote,
+                            progreso["salteados"] + min(i + self.tamano_bloque, len(pendientes)), len(legajos))
+        except Exception as e:
+            progreso["error"] = str(e)
+            raise
+        finally:
+            progreso["fin"] = time.time()
+
+    def _procesar_legajo(self, progreso, legajo, info, cubeta):
+        if info is None:
+            estado, correo_id = 'inexistente', None
+            progreso["inexistentes"] += 1
+        elif not info["email"]:
+            estado, correo_id = 'sin_email', None
+            progreso["sin_email"] += 1
+        elif not info["asignaturas"]:
+            # Cuentas sin cargos docentes (LEFT JOIN): no tienen nada que informar
+            estado, correo_id = 'sin_asignaturas', None
+            progreso["sin_asignaturas"] += 1
+        else:
+            correo = correo_info_academica(info)
+            if progreso["simulacion"]:
+                if len(progreso["muestras"]) < 3:
+                    progreso["muestras"].append(correo)
+                progreso["simulados"] += 1
+                return
+            if cubeta is not None:
+                time.sleep(cubeta.reservar(1))
+            # Contrapresión: si los workers no dan abasto no se acumulan miles de correos
+            while self.cola.en_cola() > self.rafaga:
+                time.sleep(0.05)
+            try:
+                correo_id = self.cola.encolar(**correo)
+            except Exception as e:
+                # Sin registrar progreso: se reintenta al repetir el lote
+                logger.error("Envío masivo %s: no se pudo encolar el legajo %s: %s", progreso["lote"], legajo, e)
+                progreso["errores"] += 1
+                return
+            estado = 'encolado'
+            progreso["encolados"] += 1
+        if progreso["simulacion"]:
+            return
+        with self._lock:
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO envios_masivos (lote, legajo, estado, correo_id, actualizado) "
+                "VALUES (?, ?, ?, ?, ?)", (progreso["lote"], legajo, estado, correo_id, time.time())
+            )
+            self._conexion.commit()
+
+    def estado(self, lote):
+        """Progreso del lote en este proceso (si corrió acá) y lo registrado en el spool"""
+        with self._lock:
+            por_estado = dict(self._conexion.execute(
+                "SELECT estado, COUNT(*) FROM envios_masivos WHERE lote = ? GROUP BY estado", (lote,)
+            ).fetchall())
+            progreso = self._lote_en_curso.get(lote)
+        if progreso is None and not por_estado:
+            return None
+        resumen = dict(progreso) if progreso is not None else {"lote": lote}
+        resumen["en_curso"] = progreso is not None and progreso["fin"] is None
+        resumen["registrados"] = por_estado
+        return resumen
+
+
+envio_masivo = EnvioMasivo(
+    cola=cola_correos,
+    ruta_spool=app.config['CORREO_SPOOL'],
+    por_minuto=app.config['ENVIO_MASIVO_POR_MINUTO'],
+    rafaga=app.config['ENVIO_MASIVO_RAFAGA'],
+    tamano_bloque=app.config['ENVIO_MASIVO_BLOQUE'],
+)
+
+# =============================================================================
+# AGENTE ROUTER - Detecta el tipo de consulta
+# =============================================================================
+
+TIPOS_CONSULTA = ['SRAT', 'DATABASE', 'GENERAL']
+
+# Palabras clave por tipo de consulta. Se usan tanto para el prompt del router
+# como para el clasificador determinístico (lo que va entre paréntesis es solo
+# contexto para el LLM y no se busca en el mensaje).
+PALABRAS_CLAVE = {
+    'SRAT': [
+        ["sistema", "carga", "temas", "ingreso", "acceso", "contraseña", "legajo (en contexto de login)", "SRAT"],
+        ["wifi", "FRDWLAN", "PC", "pasillo", "departamento"],
+        ["horario", "materia (en contexto de sistema)"],
+        ["problemas", "no puedo", "no aparece", "error"],
+    ],
+    'DATABASE': [
+        ["legajo (en contexto de consulta académica)"],
+        ["materias", "carreras", "información académica"],
+        ["qué materia doy", "a qué carrera pertenezco"],
+        ["consulta académica", "datos personales académicos"],
+    ],
+    'GENERAL': [
+        ["hola", "buenos días", "buenas tardes", "saludos"],
+        ["cómo estás", "qué tal"],
+        ["preguntas generales sin contexto específico"],
+    ],
+}
+
+# Patrones fuertes que suman más que una palabra clave suelta
+PATRONES_FUERTES = {
+    'SRAT': [
+        r"\b(contrasena|clave)\b",
+        r"\bno (puedo|me deja) (ingresar|entrar|acceder|cargar)\b",
+        r"\bno (me )?aparecen?\b",
+        r"\bcargar (el |los )?temas?\b",
+        r"\b(frdwlan|srat|wifi)\b",
+    ],
+    'DATABASE': [
+        r"\b(materias|carreras)\b.*(\blegajo\b|\b\d{4,6}\b)",
+        r"(\blegajo\b|\b\d{4,6}\b).*\b(materias|carreras)\b",
+        r"\bque (materias?|carreras?) (doy|dicto|tengo|pertenezco)\b",
+        r"\bmis (materias|carreras)\b",
+    ],
+    'GENERAL': [],
+}
+
+# Un problema ("no me aparecen mis materias", "no puedo ver mis carreras") menciona materias o
+# carreras pero suele ser una consulta SRAT: las reglas no deciden DATABASE, decide el LLM
+PATRON_PROBLEMA = re.compile(r"\bno (me |le |les )?(aparecen?|figuran?|puedo|anda|funciona|deja|carga)\b")
+
+PATRON_SALUDO = re.compile(
+    r"(hola|buen(os|as)?( dias?| tardes| noches)?|saludos|que tal|como estas|como va)"
+    r"([\s,!.?]+(hola|que tal|como estas|como va))*[\s,!.?]*"
+)
+PATRON_SOLO_LEGAJO = re.compile(r"((mi )?legajo( es)?[\s:]*)?\d{4,6}[\s.]*")
+
+
+def normalizar_texto(texto):
+    """Minúsculas, sin tildes y con espacios colapsados"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", texto).strip()
+
+
+def _compilar_reglas_router():
+    reglas = {}
+    for tipo, lineas in PALABRAS_CLAVE.items():
+        reglas[tipo] = []
+        for linea in lineas:
+            for palabra in linea:
+                palabra = normalizar_texto(re.sub(r"\(.*\)", "", palabra))
+                if palabra and palabra != "preguntas generales sin contexto especifico":
+                    reglas[tipo].append((re.compile(rf"\b{re.escape(palabra)}\b"), 1))
+        reglas[tipo] += [(re.compile(patron), 2) for patron in PATRONES_FUERTES[tipo]]
+    return reglas
+
+
+REGLAS_ROUTER = _compilar_reglas_router()
+
+
+def clasificar_por_reglas(mensaje, tipo_consulta_actual):
     """
-    router_prompt = ChatPromptTemplate.from_messages([
-        ("system", f"""
+    Clasificador determinístico basado en las palabras clave del router.
+    Retorna (tipo, confianza) con confianza entre 0 y 1.
+    """
+    texto = normalizar_texto(mensaje)
+    if PATRON_SALUDO.fullmatch(texto):
+        return 'GENERAL', 1.0
+    if PATRON_SOLO_LEGAJO.fullmatch(texto) and tipo_consulta_actual in ('SRAT', 'DATABASE'):
+        # Solo informa el legajo: se mantiene en el flujo actual
+        return tipo_consulta_actual, 0.9
+
+    puntajes = {
+        tipo: sum(peso for patron, peso in reglas if patron.search(texto))
+        for tipo, reglas in REGLAS_ROUTER.items()
+    }
+    (mejor, primero), (_, segundo) = sorted(puntajes.items(), key=lambda kv: kv[1], reverse=True)[:2]
+    if primero == 0:
+        return tipo_consulta_actual, 0.0
+    confianza = (primero - segundo) / primero * min(1.0, primero / 2)
+    if mejor == 'DATABASE' and PATRON_PROBLEMA.search(texto):
+        confianza = 0.0
+    return mejor, confianza
+
+
+def _renderizar_palabras_clave(tipo):
+    return "\n".join("- " + ", ".join(linea) for linea in PALABRAS_CLAVE[tipo])
+
+
+# El prompt y el cliente del router se construyen una sola vez
+router_prompt = ChatPromptTemplate.from_messages([
+    ("system", """
 Eres un clasificador de consultas. Tu única función es determinar qué tipo de consulta es el mensaje del usuario.
 El tipo de consulta actual es {tipo_consulta_actual}, si no podes contextualizarla mantene el mismo tipo de consulta.
 Por ejemplo: si estamos con SRAT o DATABASE y luego habla del legajo no vuelvas a general, MANTENETE en uno de esos dos (SRAT o DATABASE).
@@ -137,48 +1875,91 @@ TIPOS DE CONSULTA:
 3. GENERAL: Saludos, preguntas generales, o cuando no está claro el tipo de consulta.
 
 PALABRAS CLAVE PARA SRAT:
-- sistema, carga, temas, ingreso, acceso, contraseña, legajo (en contexto de login), SRAT
-- wifi, FRDWLAN, PC, pasillo, departamento
-- horario, materia (en contexto de sistema)
-- problemas, no puedo, no aparece, error
+""" + _renderizar_palabras_clave('SRAT') + """
 
 PALABRAS CLAVE PARA DATABASE:
-- legajo (en contexto de consulta académica)
-- materias, carreras, información académica
-- qué materia doy, a qué carrera pertenezco
-- consulta académica, datos personales académicos
+""" + _renderizar_palabras_clave('DATABASE') + """
 
 PALABRAS CLAVE PARA GENERAL:
-- hola, buenos días, buenas tardes, saludos
-- cómo estás, qué tal
-- preguntas generales sin contexto específico
+""" + _renderizar_palabras_clave('GENERAL') + """
 
 Responde ÚNICAMENTE con una de estas tres palabras: SRAT, DATABASE, o GENERAL
 No agregues explicaciones ni texto adicional.
-        """),
-        ("human", "{mensaje}")
-    ])
-    
-    router_llm = ChatGroq(model_name='llama-3.3-70b-versatile', temperature=0)
-    response = router_llm.invoke(router_prompt.format(mensaje=mensaje))
+    """),
+    ("human", "{mensaje}")
+])
+
+componente_router_llm = perezoso("llm_router", lambda: ChatGroqLimitado(model_name='llama-3.3-70b-versatile', temperature=0))
+
+cache_router = CacheClasificacion(
+    max_entradas=app.config['ROUTER_CACHE_MAX'],
+    ttl_segundos=app.config['ROUTER_CACHE_TTL_SEGUNDOS'],
+    ruta_sqlite=app.config['ROUTER_CACHE_SQLITE'] or None,
+)
+
+estadisticas_router = {"reglas": 0, "cache": 0, "llm": 0, "agrupada": 0}
+# Mensajes iguales que llegan juntos (p. ej. al inicio de un bloque de clases) comparten
+# una sola consulta al LLM, con la misma clave que la caché
+llamadas_router = LlamadasEnCurso()
+
+
+def clasificar_con_llm(mensaje, tipo_consulta_actual):
+    """Consulta al LLM del router; None si la respuesta no es un tipo válido"""
+    response = componente_router_llm.obtener().invoke(
+        router_prompt.format_messages(tipo_consulta_actual=tipo_consulta_actual, mensaje=mensaje),
+        config={"callbacks": [InstrumentacionLLM("router")]},
+    )
     tipo = response.content.strip().upper()
+    return tipo if tipo in TIPOS_CONSULTA else None
+
+
+def detectar_tipo_consulta(mensaje, tipo_consulta_actual, antes_de_llm=None):
+    """
+    Detecta automáticamente el tipo de consulta basado en el mensaje del usuario.
+    Primero prueba el clasificador por reglas; si la confianza es baja busca en
+    la caché de clasificaciones y solo como último recurso consulta al LLM.
+    antes_de_llm se llama justo antes de consultar al LLM (modo especulativo).
+    Retorna: 'SRAT', 'DATABASE', o 'GENERAL'
+    """
+    inicio = time.perf_counter()
+    tipo, confianza = clasificar_por_reglas(mensaje, tipo_consulta_actual)
+    if confianza >= app.config['ROUTER_UMBRAL_CONFIANZA']:
+        return _registrar_router(inicio, "reglas", tipo)
+
+    clave = CacheClasificacion.clave(mensaje, tipo_consulta_actual)
+    tipo = cache_router.obtener(clave)
+    if tipo is not None:
+        return _registrar_router(inicio, "cache", tipo)
+
+    if antes_de_llm is not None:
+        antes_de_llm()
+    tipo, agrupada = llamadas_router.ejecutar(clave, lambda: clasificar_con_llm(mensaje, tipo_consulta_actual))
+    metodo = "agrupada" if agrupada else "llm"
     
-    # Validar respuesta
-    if tipo not in ['SRAT', 'DATABASE', 'GENERAL']:
-        tipo = 'GENERAL'
+    # Validar respuesta (las respuestas inválidas no se guardan en caché)
+    if tipo is None:
+        return _registrar_router(inicio, metodo, 'GENERAL')
     
+    if not agrupada:
+        cache_router.guardar(clave, tipo)
+    return _registrar_router(inicio, metodo, tipo)
+
+
+def _registrar_router(inicio, metodo, tipo):
+    estadisticas_router[metodo] += 1
+    duracion = time.perf_counter() - inicio
+    histograma_etapas.observar(duracion, etapa="router", metodo=metodo, tipo_consulta=tipo)
+    logger.debug("etapa=router metodo=%s tipo_consulta=%s duracion_ms=%.2f", metodo, tipo, duracion * 1000)
     return tipo
 
 # =============================================================================
 # AGENTE SRAT - Maneja consultas sobre el sistema
 # =============================================================================
 
-def crear_agente_srat():
+def crear_agente_srat(especulativo=False):
     """Crea el agente especializado en consultas SRAT"""
     
     # Herramientas para SRAT (solo Gmail)
-    gmail_tools = toolkit.get_tools()
-    
     srat_prompt = ChatPromptTemplate.from_messages([
         ("system", """
 Eres un asistente virtual especializado en ayudar a los profesores con el sistema de carga de temas. 
@@ -226,13 +2007,13 @@ REGLAS DE RESPUESTA:
         MessagesPlaceholder(variable_name="messages"),
     ])
     
-    return create_react_agent(llm, gmail_tools, prompt=srat_prompt)
+    return create_react_agent(componente_llm.obtener(), obtener_herramientas_gmail(especulativo), prompt=srat_prompt)
 
 # =============================================================================
 # AGENTE DATABASE - Maneja consultas académicas
 # =============================================================================
 
-def crear_agente_database():
+def crear_agente_database(especulativo=False):
     """Crea el agente especializado en consultas de base de datos académicas"""
     
     # Herramienta para consultar usuarios
@@ -248,8 +2029,7 @@ def crear_agente_database():
     )
     
     # Herramientas para database (consulta + Gmail como fallback)
-    gmail_tools = toolkit.get_tools()
-    database_tools = [herramienta_usuarios, herramienta_email] + gmail_tools
+    database_tools = [herramienta_usuarios, herramienta_email] + obtener_herramientas_gmail(especulativo)
     
     database_prompt = ChatPromptTemplate.from_messages([
         ("system", """
@@ -316,7 +2096,7 @@ REGLAS DE RESPUESTA:
         MessagesPlaceholder(variable_name="messages"),
     ])
     
-    return create_react_agent(llm, database_tools, prompt=database_prompt)
+    return create_react_agent(componente_llm.obtener(), database_tools, prompt=database_prompt)
 
 # =============================================================================
 # AGENTE GENERAL - Maneja saludos y preguntas generales
@@ -352,109 +2132,1219 @@ NUNCA digas que no puedes ayudar o que solo haces una cosa específica. Siempre
         MessagesPlaceholder(variable_name="messages"),
     ])
     
-    return create_react_agent(llm, [], prompt=general_prompt)
+    return create_react_agent(componente_llm.obtener(), [], prompt=general_prompt)
 
 # =============================================================================
-# AGENTE PRINCIPAL - Coordina todos los agentes
+# REGISTRO DE AGENTES - Compilados una vez y compartidos entre sesiones
 # =============================================================================
 
-class ChatbotAgentes:
+class RegistroAgentes:
+    """
+    Compila cada agente una sola vez (en el primer uso o en el precalentamiento)
+    y lo comparte entre sesiones. Los grafos no guardan estado de conversación:
+    el historial se pasa en cada invocación, por lo que pueden usarse en
+    paralelo desde varias sesiones. Los agentes con herramientas de correo
+    tienen además una variante especulativa con herramientas sin efectos
+    inmediatos (ver HERRAMIENTAS_GMAIL_ESPECULATIVAS).
+    """
+
+    FABRICAS = {
+        'SRAT': crear_agente_srat,
+        'DATABASE': crear_agente_database,
+        'GENERAL': crear_agente_general,
+    }
+    # GENERAL no tiene herramientas: su variante especulativa es el mismo agente
+    CON_VARIANTE_ESPECULATIVA = ('SRAT', 'DATABASE')
+
     def __init__(self):
-        self.srat_agent = crear_agente_srat()
-        self.database_agent = crear_agente_database()
-        self.general_agent = crear_agente_general()
+        self._agentes = {}
+        self._especulativos = {}
+        self.tiempos_compilacion = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, tipo_consulta, especulativo=False):
+        """Devuelve el agente para el tipo de consulta (GENERAL si no existe)"""
+        if tipo_consulta not in self.FABRICAS:
+            tipo_consulta = 'GENERAL'
+        if especulativo and tipo_consulta in self.CON_VARIANTE_ESPECULATIVA:
+            agentes, nombre = self._especulativos, f"{tipo_consulta}_especulativo"
+        else:
+            agentes, nombre, especulativo = self._agentes, tipo_consulta, False
+        agente = agentes.get(tipo_consulta)
+        if agente is None:
+            with self._lock:
+                agente = agentes.get(tipo_consulta)
+                if agente is None:
+                    inicio = time.perf_counter()
+                    fabrica = self.FABRICAS[tipo_consulta]
+                    agente = fabrica(especulativo=True) if especulativo else fabrica()
+                    self.tiempos_compilacion[nombre] = time.perf_counter() - inicio
+                    agentes[tipo_consulta] = agente
+                    logger.info("Agente %s compilado en %.0fms", nombre, self.tiempos_compilacion[nombre] * 1000)
+        return agente
+
+    def compilar_todos(self, especulativos=False):
+        for tipo in self.FABRICAS:
+            self.obtener(tipo)
+            if especulativos:
+                self.obtener(tipo, especulativo=True)
+
+    def estado(self):
+        return {
+            "listo": len(self._agentes) == len(self.FABRICAS),
+            "compilados": list(self._agentes),
+        }
+
+    def estadisticas(self):
+        return {
+            "agentes": list(self._agentes),
+            "tiempos_compilacion_ms": {tipo: round(seg * 1000, 1) for tipo, seg in self.tiempos_compilacion.items()},
+        }
+
+# =============================================================================
+# HISTORIAL PERSISTENTE - Conversaciones en base de datos con escritura diferida
+# =============================================================================
+
+metadata_historial = MetaData()
+
+tabla_sesiones = Table(
+    "chat_sesiones", metadata_historial,
+    Column("sesion_id", String(32), primary_key=True),
+    Column("resumen", Text, nullable=False),
+    Column("legajo", Integer),
+    Column("tipo_consulta", String(16), nullable=False),
+    # Mensajes ya plegados en el resumen: al recuperar la sesión se saltean
+    Column("mensajes_resumidos", Integer, nullable=False),
+    Column("actualizada", Float, nullable=False, index=True),
+)
+
+tabla_mensajes = Table(
+    "chat_mensajes", metadata_historial,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("sesion_id", String(32), nullable=False, index=True),
+    Column("rol", String(8), nullable=False),
+    Column("contenido", Text, nullable=False),
+    Column("creado", Float, nullable=False),
+)
+
+
+class HistorialSQL:
+    """
+    Guarda cada conversación (mensajes y estado de la sesión) en la base.
+    Las escrituras se encolan y un hilo las graba por lotes en una sola
+    transacción, fuera del camino de /chat. Ese mismo hilo crea las tablas en
+    su primer ciclo y, si la base no responde, lo reintenta en los siguientes.
+    Las sesiones que ya no están en memoria (reinicio o desalojo) se recuperan
+    al volver el usuario.
+    """
+
+    REINTENTOS_LECTURA = 3
+
+    def __init__(self, engine, intervalo_segundos, lote_max):
+        self.engine = engine
+        self.intervalo_segundos = intervalo_segundos
+        self.lote_max = lote_max
+        self._pendientes = deque()
+        self._lock_pendientes = threading.Lock()
+        self._fallido = []
+        # Lote que se está grabando y cantidad de lotes confirmados: cargar()
+        # los usa para no leer dos veces (ni perder) un lote a mitad de camino
+        self._en_escritura = []
+        self._confirmados = 0
+        self._lock_escritura = threading.Lock()
+        self._tablas_listas = False
+        self.mensajes_escritos = 0
+        self.estados_escritos = 0
+        self.lotes = 0
+        self.errores = 0
+        self.recuperadas = 0
+        self.podadas = 0
+        threading.Thread(target=self._escribir_periodicamente, daemon=True, name="historial").start()
+        # Lo pendiente se graba también al apagar el servidor
+        atexit.register(self.vaciar)
+
+    def _encolar(self, tipo, datos):
+        with self._lock_pendientes:
+            self._pendientes.append((tipo, datos))
+
+    def registrar_mensaje(self, sesion_id, rol, contenido):
+        self._encolar("mensaje", {
+            "sesion_id": sesion_id,
+            "rol": rol,
+            "contenido": contenido,
+            "creado": time.time(),
+        })
+
+    def registrar_estado(self, sesion):
+        self._encolar("estado", {
+            "sesion_id": sesion.id,
+            "resumen": sesion.resumen,
+            "legajo": sesion.legajo,
+            "tipo_consulta": sesion.tipo_consulta_actual,
+            "mensajes_resumidos": sesion.mensajes_resumidos,
+            "actualizada": time.time(),
+        })
+
+    def _escribir_periodicamente(self):
+        while True:
+            time.sleep(self.intervalo_segundos)
+            self.vaciar()
+
+    def vaciar(self):
+        """Graba todo lo pendiente en lotes de hasta lote_max operaciones"""
+        with self._lock_escritura:
+            if not self._tablas_listas:
+                try:
+                    metadata_historial.create_all(self.engine)
+                    self._tablas_listas = True
+                except Exception as e:
+                    self.errores += 1
+                    logger.error("No se pudieron crear las tablas del historial (se reintenta): %s", e)
+                    return
+            while True:
+                with self._lock_pendientes:
+                    lote, self._fallido = self._fallido, []
+                    while self._pendientes and len(lote) < self.lote_max:
+                        lote.append(self._pendientes.popleft())
+                    self._en_escritura = lote
+                if not lote:
+                    return
+                try:
+                    with medir("historial"):
+                        self._escribir(lote)
+                except Exception as e:
+                    # Se reintenta en el próximo ciclo conservando el orden
+                    self.errores += 1
+                    with self._lock_pendientes:
+                        self._fallido, self._en_escritura = lote, []
+                    logger.error("Error grabando historial (%d operaciones pendientes): %s", len(lote), e)
+                    return
+                with self._lock_pendientes:
+                    self._en_escritura = []
+                    self._confirmados += 1
+
+    def _escribir(self, lote):
+        mensajes = [datos for tipo, datos in lote if tipo == "mensaje"]
+        # De cada sesión alcanza con el último estado del lote
+        estados = {datos["sesion_id"]: datos for tipo, datos in lote if tipo == "estado"}
+        with self.engine.begin() as conexion:
+            if mensajes:
+                conexion.execute(insert(tabla_mensajes), mensajes)
+            for estado in estados.values():
+                resultado = conexion.execute(
+                    update(tabla_sesiones)
+                    .where(tabla_sesiones.c.sesion_id == estado["sesion_id"])
+                    .values(**estado)
+                )
+                if resultado.rowcount == 0:
+                    conexion.execute(insert(tabla_sesiones).values(**estado))
+        self.lotes += 1
+        self.mensajes_escritos += len(mensajes)
+        self.estados_escritos += len(estados)
+
+    def cargar(self, sesion_id):
+        """
+        Devuelve el estado y los mensajes no resumidos de la sesión, o None si
+        no existe. No graba nada: a lo ya persistido se le suma lo que la sesión
+        tiene todavía en la cola o en el lote que se está grabando. No espera al
+        hilo escritor: si un lote se confirma mientras se lee la base, la
+        lectura puede o no incluirlo, así que se repite.
+        """
+        for _ in range(self.REINTENTOS_LECTURA):
+            with self._lock_pendientes:
+                confirmados = self._confirmados
+                tablas_listas = self._tablas_listas
+                pendientes = [(tipo, datos) for tipo, datos in self._en_escritura + self._fallido + list(self._pendientes)
+                              if datos["sesion_id"] == sesion_id]
+            estado, mensajes, salteados = None, [], 0
+            if tablas_listas:
+                with self.engine.connect() as conexion:
+                    estado = conexion.execute(
+                        select(tabla_sesiones).where(tabla_sesiones.c.sesion_id == sesion_id)
+                    ).mappings().first()
+                    salteados = estado["mensajes_resumidos"] if estado is not None else 0
+                    mensajes = [tuple(fila) for fila in conexion.execute(
+                        select(tabla_mensajes.c.rol, tabla_mensajes.c.contenido)
+                        .where(tabla_mensajes.c.sesion_id == sesion_id)
+                        .order_by(tabla_mensajes.c.id)
+                        .offset(salteados)
+                    )]
+            with self._lock_pendientes:
+                if self._confirmados == confirmados:
+                    break
+        else:
+            logger.warning("Historial: la sesión %s se cargó mientras se grababan lotes", sesion_id)
+
+        for tipo, datos in pendientes:
+            if tipo == "mensaje":
+                mensajes.append((datos["rol"], datos["contenido"]))
+            else:
+                estado = datos
+        if estado is None:
+            return None
+        self.recuperadas += 1
+        return dict(estado, mensajes=mensajes[estado["mensajes_resumidos"] - salteados:])
+
+    def podar(self, retencion_segundos):
+        """Borra las sesiones (y sus mensajes) sin actividad en el período de retención"""
+        if not self._tablas_listas:
+            return 0
+        corte = time.time() - retencion_segundos
+        viejas = select(tabla_sesiones.c.sesion_id).where(tabla_sesiones.c.actualizada < corte)
+        with self.engine.begin() as conexion:
+            conexion.execute(delete(tabla_mensajes).where(tabla_mensajes.c.sesion_id.in_(viejas)))
+            borradas = conexion.execute(delete(tabla_sesiones).where(tabla_sesiones.c.actualizada < corte)).rowcount
+        self.podadas += borradas
+        if borradas:
+            logger.info("Historial: %d sesiones podadas (sin actividad en %d días)", borradas, retencion_segundos // 86400)
+        return borradas
+
+    def iniciar_poda(self, retencion_segundos, intervalo_segundos):
+        def podar_periodicamente():
+            while True:
+                try:
+                    self.podar(retencion_segundos)
+                except Exception as e:
+                    logger.error("Error podando el historial: %s", e)
+                time.sleep(intervalo_segundos)
+
+        threading.Thread(target=podar_periodicamente, daemon=True, name="historial-poda").start()
+
+    def estadisticas(self):
+        return {
+            "pendientes": len(self._pendientes) + len(self._fallido) + len(self._en_escritura),
+            "tablas_listas": self._tablas_listas,
+            "mensajes_escritos": self.mensajes_escritos,
+            "estados_escritos": self.estados_escritos,
+            "lotes": self.lotes,
+            "errores": self.errores,
+            "sesiones_recuperadas": self.recuperadas,
+            "sesiones_podadas": self.podadas,
+        }
+
+# =============================================================================
+# SESIONES - Una conversación por usuario con memoria acotada
+# =============================================================================
+
+def extraer_legajo(mensaje):
+    """Extrae el legajo mencionado en el mensaje ('legajo 50443' o solo el número)"""
+    texto = normalizar_texto(mensaje)
+    match = re.search(r"legajo\D*(\d{4,6})", texto)
+    if not match and PATRON_SOLO_LEGAJO.fullmatch(texto):
+        match = re.search(r"(\d{4,6})", texto)
+    return int(match.group(1)) if match else None
+
+
+class Sesion:
+    """
+    Estado de una conversación: la ventana de historial reciente, el resumen
+    de los turnos anteriores, el legajo informado y el tipo de consulta actual
+    """
+
+    def __init__(self, sesion_id, historial=None):
+        self.id = sesion_id
         self.chat_history = ChatMessageHistory()
+        self.resumen = ""
+        self.legajo = None
+        # Intención del motor de intenciones que espera el legajo o una confirmación
+        self.intencion_pendiente = None
         self.tipo_consulta_actual = 'GENERAL'
+        self.mensajes_resumidos = 0
+        self.ultimo_acceso = time.time()
+        self.bytes = 0
+        self.historial = historial
+        # Serializa los mensajes de una misma sesión; sesiones distintas corren en paralelo
+        self.lock = threading.Lock()
 
-    def procesar_mensaje(self, mensaje):
-        """Procesa un mensaje usando el agente apropiado"""
-        
-        # 1. Detectar tipo de consulta
-        tipo_consulta = detectar_tipo_consulta(mensaje,self.tipo_consulta_actual)
-        print(f"tipo_consulta={tipo_consulta}")
-        # 2. Agregar mensaje al historial
+    def restaurar(self, datos):
+        """Carga el estado recuperado del historial persistente"""
+        self.resumen = datos["resumen"]
+        self.legajo = datos["legajo"]
+        self.tipo_consulta_actual = datos["tipo_consulta"]
+        self.mensajes_resumidos = datos["mensajes_resumidos"]
+        self.chat_history.messages = [
+            HumanMessage(content=contenido) if rol == "human" else AIMessage(content=contenido)
+            for rol, contenido in datos["mensajes"]
+        ]
+        self.recalcular_bytes()
+
+    def agregar_mensaje_usuario(self, mensaje):
         self.chat_history.add_user_message(mensaje)
-        
-        # 2.5. Rama determinística para DATABASE sensible
-        if tipo_consulta == 'DATABASE':
-            mensaje_min = mensaje.lower()
-            contiene_palabras_sensibles = any(k in mensaje_min for k in ["materia", "materias", "carrera", "carreras"]) \
-                and ("legajo" in mensaje_min or re.search(r"\b\d{4,6}\b", mensaje_min))
-            if contiene_palabras_sensibles:
-                # Extraer legajo (primer número de 4-6 dígitos o después de la palabra legajo)
-                match = re.search(r"legajo\D*(\d{4,6})", mensaje_min)
-                if not match:
-                    match = re.search(r"\b(\d{4,6})\b", mensaje_min)
-                if not match:
-                    self.tipo_consulta_actual = tipo_consulta
-                    return {
-                        "response": "Para poder enviarte tu información académica, decime tu legajo.",
-                        "tipo_consulta": tipo_consulta
-                    }
-                legajo = int(match.group(1))
-
-                info = consultar_usuario_asignaturas(legajo)
-                email = obtener_email_por_legajo(legajo)
-
-                if email:
-                    try:
-                        send_tool = next((t for t in toolkit.get_tools() if t.name == "send_gmail_message"), None)
-                        if send_tool:
-                            send_tool.invoke({
-                                "to": [email],
-                                "subject": "Tu información académica",
-                                "message": f"Legajo: {legajo}\n\n{info}"
-                            })
-                        respuesta_chat = "Te envié la información a tu correo institucional asociado al legajo."
-                    except Exception as e:
-                        respuesta_chat = "Ocurrió un problema al enviar el correo. ¿Podés confirmar otra dirección de email para reenviar la información?"
-                else:
-                    respuesta_chat = "No encuentro un correo institucional asociado a tu legajo. Decime un email para enviarte la información."
-
-                # Guardar respuesta en historial y devolver
-                self.chat_history.add_ai_message(respuesta_chat)
-                self.tipo_consulta_actual = tipo_consulta
-                return {
-                    "response": respuesta_chat,
-                    "tipo_consulta": tipo_consulta
-                }
-
-        # 3. Seleccionar agente apropiado
-        if tipo_consulta == 'SRAT':
-            agent_executor = self.srat_agent
-            
-        elif tipo_consulta == 'DATABASE':
-            agent_executor = self.database_agent
-        elif tipo_consulta == 'GENERAL':
-            agent_executor = self.general_agent
-        else:
-            agent_executor = self.general_agent
-        
-        # 4. Ejecutar agente
-        events = agent_executor.stream(
-            {"messages": self.chat_history.messages},
-            stream_mode="values"
+        self.bytes += len(mensaje.encode('utf-8'))
+        legajo = extraer_legajo(mensaje)
+        if legajo is not None:
+            self.legajo = legajo
+        if self.historial is not None:
+            self.historial.registrar_mensaje(self.id, "human", mensaje)
+
+    def agregar_mensaje_ia(self, mensaje):
+        self.chat_history.add_ai_message(mensaje)
+        self.bytes += len(mensaje.encode('utf-8'))
+        if self.historial is not None:
+            self.historial.registrar_mensaje(self.id, "ai", mensaje)
+
+    def recalcular_bytes(self):
+        self.bytes = len(self.resumen.encode('utf-8')) + sum(
+            len(str(m.content).encode('utf-8')) for m in self.chat_history.messages
+        )
+
+
+class GestorSesiones:
+    """
+    Mantiene las sesiones activas con desalojo LRU, expiración por inactividad
+    y límites de cantidad de sesiones y de bytes de historial.
+    """
+
+    def __init__(self, max_sesiones, ttl_segundos, max_bytes, historial=None):
+        self.max_sesiones = max_sesiones
+        self.ttl_segundos = ttl_segundos
+        self.max_bytes = max_bytes
+        self.historial = historial
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+        self.expiradas = 0
+        self.desalojadas = 0
+
+    @staticmethod
+    def _id_valido(sesion_id):
+        return bool(sesion_id) and re.fullmatch(r"[0-9a-f]{32}", sesion_id) is not None
+
+    def obtener(self, sesion_id):
+        """
+        Devuelve (sesion, es_nueva) para el id dado. Si no está en memoria se
+        busca en el historial persistente y, si tampoco está o expiró por
+        inactividad, se crea una nueva.
+        """
+        generado = not self._id_valido(sesion_id)
+        if generado:
+            sesion_id = uuid.uuid4().hex
+        with self._lock:
+            self._purgar_expiradas(time.time())
+            en_memoria = sesion_id in self._sesiones
+
+        recuperada = None
+        # Un id recién generado no puede estar en el historial
+        if not en_memoria and not generado and self.historial is not None:
+            # La consulta se hace sin tomar el lock para no frenar a las demás sesiones
+            try:
+                datos = self.historial.cargar(sesion_id)
+            except Exception as e:
+                logger.error("Error recuperando la sesión %s del historial: %s", sesion_id, e)
+                datos = None
+            if datos is not None and time.time() - datos["actualizada"] >= self.ttl_segundos:
+                # Expirada (p. ej. una PC compartida): ni la conversación ni el legajo pasan
+                # al próximo usuario; la sesión nueva usa otro id para no mezclar historiales
+                logger.debug("Sesión %s expirada en el historial, se crea una nueva", sesion_id)
+                datos = None
+                sesion_id = uuid.uuid4().hex
+            if datos is not None:
+                recuperada = Sesion(sesion_id, self.historial)
+                recuperada.restaurar(datos)
+
+        with self._lock:
+            sesion = self._sesiones.get(sesion_id)
+            es_nueva = sesion is None and recuperada is None
+            if sesion is None:
+                sesion = recuperada or Sesion(sesion_id, self.historial)
+                self._sesiones[sesion_id] = sesion
+            else:
+                self._sesiones.move_to_end(sesion_id)
+            sesion.ultimo_acceso = time.time()
+            self._ajustar_limites(conservar=sesion_id)
+            return sesion, es_nueva
+
+    def registrar_uso(self, sesion):
+        """
+        Actualiza el acceso de la sesión, encola su estado para el historial
+        persistente y aplica los límites de memoria
+        """
+        if self.historial is not None:
+            self.historial.registrar_estado(sesion)
+        with self._lock:
+            sesion.ultimo_acceso = time.time()
+            if sesion.id in self._sesiones:
+                self._sesiones.move_to_end(sesion.id)
+            self._ajustar_limites(conservar=sesion.id)
+
+    def _purgar_expiradas(self, ahora):
+        while self._sesiones:
+            sesion_id, sesion = next(iter(self._sesiones.items()))
+            if ahora - sesion.ultimo_acceso < self.ttl_segundos:
+                break
+            del self._sesiones[sesion_id]
+            self.expiradas += 1
+
+    def _ajustar_limites(self, conservar):
+        while len(self._sesiones) > self.max_sesiones or self._bytes_totales() > self.max_bytes:
+            sesion_id = next(iter(self._sesiones))
+            if sesion_id == conservar:
+                break
+            del self._sesiones[sesion_id]
+            self.desalojadas += 1
+
+    def _bytes_totales(self):
+        return sum(s.bytes for s in self._sesiones.values())
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "sesiones_activas": len(self._sesiones),
+                "bytes_historial": self._bytes_totales(),
+                "sesiones_expiradas": self.expiradas,
+                "sesiones_desalojadas": self.desalojadas,
+                "max_sesiones": self.max_sesiones,
+                "max_bytes": self.max_bytes,
+            }
+
+# =============================================================================
+# CONTEXTO - Ventana de historial y resumen incremental
+# =============================================================================
+
+resumen_prompt = ChatPromptTemplate.from_messages([
+    ("system", """
+Resumís conversaciones entre un asistente virtual de la facultad y un profesor.
+Vas a recibir el resumen anterior (puede estar vacío) y los mensajes nuevos que salen de la ventana de contexto.
+Devolvé un único resumen actualizado, breve (máximo 8 líneas), en español, que conserve:
+- el problema o la consulta del usuario y en qué estado quedó
+- nombre, apellido, legajo, materia, carrera y correo si el usuario los dio
+- si el asistente ya envió un correo y a quién
+No agregues información que no esté en los mensajes.
+    """),
+    ("human", "RESUMEN ANTERIOR:\n{resumen}\n\nMENSAJES NUEVOS:\n{mensajes}")
+])
+
+
+def contar_tokens_aproximados(mensajes):
+    """Estimación rápida de tokens (~4 caracteres por token más un costo fijo por mensaje)"""
+    return sum(len(str(m.content)) // 4 + 4 for m in mensajes)
+
+
+class GestorContexto:
+    """
+    Acota el contexto que recibe cada agente: los últimos turnos se pasan
+    textuales, los anteriores se pliegan en un resumen que se actualiza de forma
+    incremental (resumen anterior + mensajes que salen de la ventana) y el total
+    se recorta al presupuesto de tokens de cada agente. El resumen se calcula
+    en segundo plano, después de responder, y a lo sumo uno por sesión a la vez.
+    """
+
+    def __init__(self, llm_resumen, turnos_verbatim, lote_resumen, presupuestos, ejecutor):
+        self.llm_resumen = llm_resumen
+        self.turnos_verbatim = turnos_verbatim
+        self.lote_resumen = lote_resumen
+        self.presupuestos = presupuestos
+        self.ejecutor = ejecutor
+        self._programadas = set()
+        self._lock = threading.Lock()
+        self.resumenes = 0
+        self.errores_resumen = 0
+
+    def mensajes_para_agente(self, sesion, tipo_consulta):
+        """Mensajes a enviar al agente: contexto (resumen/legajo) + ventana recortada"""
+        contexto = []
+        if sesion.resumen:
+            contexto.append(f"Resumen de la conversación anterior:\n{sesion.resumen}")
+        if sesion.legajo is not None:
+            contexto.append(f"Legajo informado por el usuario: {sesion.legajo}")
+        mensajes = ([SystemMessage(content="\n\n".join(contexto))] if contexto else []) + sesion.chat_history.messages
+
+        presupuesto = self.presupuestos.get(tipo_consulta, self.presupuestos['GENERAL'])
+        recortados = trim_messages(
+            mensajes,
+            max_tokens=presupuesto,
+            token_counter=contar_tokens_aproximados,
+            strategy="last",
+            start_on="human",
+            include_system=True,
+        )
+        if not any(m.type == "human" for m in recortados):
+            # El último mensaje del usuario siempre se envía, aunque exceda el presupuesto
+            recortados = [m for m in recortados if m.type == "system"] + sesion.chat_history.messages[-1:]
+        return recortados
+
+    def programar_compactacion(self, sesion):
+        """Encola la compactación de la sesión, salvo que ya haya una pendiente"""
+        with self._lock:
+            if sesion.id in self._programadas:
+                return
+            self._programadas.add(sesion.id)
+        self.ejecutor.submit(self._compactar_programada, sesion)
+
+    def _compactar_programada(self, sesion):
+        try:
+            self.compactar(sesion)
+        except Exception:
+            logger.exception("Error compactando la sesión %s", sesion.id)
+        finally:
+            with self._lock:
+                self._programadas.discard(sesion.id)
+
+    def compactar(self, sesion):
+        """
+        Si la ventana supera turnos_verbatim + lote_resumen turnos, pliega los
+        turnos más viejos en el resumen y los saca del historial de la sesión.
+        El lock de la sesión se toma solo para leer y para aplicar el resultado:
+        mientras el modelo resume, la sesión puede seguir atendiendo mensajes.
+        """
+        with sesion.lock:
+            mensajes = list(sesion.chat_history.messages)
+            resumen = sesion.resumen
+        inicios_turno = [i for i, m in enumerate(mensajes) if m.type == "human"]
+        if len(inicios_turno) <= self.turnos_verbatim + self.lote_resumen:
+            return
+        corte = inicios_turno[-self.turnos_verbatim]
+        viejos = mensajes[:corte]
+        nuevo_resumen = self._resumir(resumen, viejos)
+        with sesion.lock:
+            # Mientras tanto solo se agregan mensajes al final; los viejos siguen al principio
+            actuales = sesion.chat_history.messages
+            if len(actuales) < corte or any(a is not b for a, b in zip(actuales, viejos)):
+                return
+            sesion.resumen = nuevo_resumen
+            sesion.chat_history.messages = actuales[corte:]
+            sesion.mensajes_resumidos += len(viejos)
+            sesion.recalcular_bytes()
+            if sesion.historial is not None:
+                sesion.historial.registrar_estado(sesion)
+
+    def _resumir(self, resumen, mensajes):
+        texto = "\n".join(
+            f"{'Usuario' if m.type == 'human' else 'Asistente'}: {m.content}" for m in mensajes
         )
+        try:
+            respuesta = self.llm_resumen.obtener().invoke(
+                resumen_prompt.format_messages(resumen=resumen, mensajes=texto),
+                config={"callbacks": [InstrumentacionLLM("resumen")]},
+            )
+            self.resumenes += 1
+            return respuesta.content.strip()
+        except Exception as e:
+            # Sin LLM: se conserva un extracto recortado para no perder el contexto
+            self.errores_resumen += 1
+            logger.warning("Error resumiendo historial: %s", e)
+            return (resumen + "\n" + texto)[-2000:].strip()
+
+    def estadisticas(self):
+        return {
+            "turnos_verbatim": self.turnos_verbatim,
+            "lote_resumen": self.lote_resumen,
+            "presupuestos_tokens": self.presupuestos,
+            "resumenes": self.resumenes,
+            "resumenes_pendientes": len(self._programadas),
+            "errores_resumen": self.errores_resumen,
+        }
+
+# =============================================================================
+# ESPECULACIÓN - Agente del turno anterior en paralelo con el router
+# =============================================================================
+
+estadisticas_especulacion = {
+    "lanzadas": 0,
+    "aceptadas": 0,
+    "descartadas": 0,
+    "tokens_desperdiciados": 0,
+    "correos_descartados": 0,
+    "precargas_academicas": 0,
+}
+_lock_especulacion = threading.Lock()
+ejecutor_precargas = ThreadPoolExecutor(max_workers=2, thread_name_prefix="precarga")
+
+
+def _contar_especulacion(clave, cantidad=1):
+    with _lock_especulacion:
+        estadisticas_especulacion[clave] += cantidad
+
+
+class ContadorTokens(BaseCallbackHandler):
+    """Suma los tokens de todas las llamadas al LLM de una ejecución"""
+
+    def __init__(self):
+        self.total = 0
+
+    def on_llm_end(self, response, **kwargs):
+        entrada, salida = _contar_tokens(response)
+        self.total += entrada + salida
+
+
+class EjecucionEspeculativa:
+    """
+    Ejecuta un agente en un hilo antes de conocer la clasificación del router.
+    Los eventos se guardan en una cola hasta que se confirma (y se consumen como
+    los de una ejecución normal) o se descarta (el hilo se detiene en el
+    próximo evento). Los correos quedan diferidos hasta la confirmación y, si se
+    descarta, sus tokens se cuentan como desperdiciados.
+    """
+
+    def __init__(self, tipo_consulta, agente, mensajes, stream_mode):
+        self.tipo_consulta = tipo_consulta
+        self.correos_diferidos = []
+        self._eventos = queue.Queue()
+        self._tokens = ContadorTokens()
+        self._lock = threading.Lock()
+        self._descartada = False
+        self._terminada = False
+        config = {
+            "callbacks": [InstrumentacionLLM("agente", tipo_consulta), self._tokens],
+            "configurable": {"correos_diferidos": self.correos_diferidos},
+        }
+        _contar_especulacion("lanzadas")
+        threading.Thread(target=self._ejecutar, args=(agente, mensajes, config, stream_mode),
+                         daemon=True, name="especulacion").start()
+
+    def _ejecutar(self, agente, mensajes, config, stream_mode):
+        try:
+            with app.app_context():
+                for evento in agente.stream({"messages": mensajes}, config=config, stream_mode=stream_mode):
+                    if self._descartada:
+                        break
+                    self._eventos.put(("evento", evento))
+        except Exception as e:
+            self._eventos.put(("error", e))
+        finally:
+            self._eventos.put(("fin", None))
+            with self._lock:
+                self._terminada = True
+                descartada = self._descartada
+            if descartada:
+                self._contar_desperdicio()
+
+    def resolver(self, tipo_consulta):
+        """Confirma la ejecución si el router eligió el mismo agente; si no, la descarta"""
+        if tipo_consulta == self.tipo_consulta:
+            _contar_especulacion("aceptadas")
+            return True
+        self.descartar()
+        return False
+
+    def descartar(self):
+        with self._lock:
+            self._descartada = True
+            terminada = self._terminada
+        _contar_especulacion("descartadas")
+        # Si todavía corre, el desperdicio (incluida la llamada en curso) se cuenta al terminar
+        if terminada:
+            self._contar_desperdicio()
+
+    def _contar_desperdicio(self):
+        _contar_especulacion("tokens_desperdiciados", self._tokens.total)
+        _contar_especulacion("correos_descartados", len(self.correos_diferidos))
+
+    def eventos(self):
+        """Eventos del agente ya confirmado; al terminar encola los correos diferidos"""
+        while True:
+            tipo, valor = self._eventos.get()
+            if tipo == "fin":
+                break
+            if tipo == "error":
+                raise valor
+            yield valor
+        for correo in self.correos_diferidos:
+            cola_correos.encolar(**correo)
+
+
+def precargar_info_academica(legajo):
+    """Consulta en segundo plano la información académica del legajo para dejarla en caché"""
+    def precargar():
+        with app.app_context():
+            consultar_info_academica(legajo)
+
+    _contar_especulacion("precargas_academicas")
+    return ejecutor_precargas.submit(precargar)
+
+
+def resumen_especulacion():
+    with _lock_especulacion:
+        estadisticas = dict(estadisticas_especulacion)
+    resueltas = estadisticas["aceptadas"] + estadisticas["descartadas"]
+    estadisticas["tasa_aciertos"] = round(estadisticas["aceptadas"] / resueltas, 3) if resueltas else 0.0
+    return estadisticas
+
+# =============================================================================
+# INTENCIONES - Consultas académicas frecuentes resueltas sin LLM
+# =============================================================================
+
+# Palabras que indican cada intención (normalizadas, sin tildes)
+INTENCION_POR_PALABRA = {
+    "materia": "materias", "materias": "materias", "asignatura": "materias", "asignaturas": "materias",
+    "carrera": "carreras", "carreras": "carreras",
+    "email": "email", "mail": "email", "correo": "email",
+}
+# La consulta tiene que ser sobre el propio usuario ("mis materias", "qué materias doy")
+MARCAS_PERSONALES = frozenset("mi mis mio mia mios mias doy dicto tengo legajo".split())
+# Relleno admitido en una consulta que el motor resuelve solo: cualquier otra palabra
+# la vuelve una pregunta libre, que sigue al router y al agente
+PALABRAS_RELLENO = MARCAS_PERSONALES | frozenset("""
+a al asociado asociada cual cuales cuantas de del decime dime el en enviame es esta este favor hola
+informacion academica institucional la las los mandame me numero oficial pasame para por porfa
+que quiero registrado saber se son sobre soy tambien tu ver y ya
+""".split())
+PATRON_NUMERO_LEGAJO = re.compile(r"\d{4,6}")
+PATRON_AFIRMACION = re.compile(
+    r"(si+|dale|ok|okay|bueno|claro|perfecto|de acuerdo|por favor|porfa|enviamelo|enviamelas|mandamelo|mandamelas)"
+    r"( (si|dale|gracias|por favor|porfa))*"
+)
+PATRON_NEGACION = re.compile(r"(no|nop|no gracias|no hace falta|no por ahora|asi esta bien|dejalo)( gracias)?")
+
+PEDIDO_LEGAJO = {
+    "info": "Para poder enviarte tu información académica, decime tu legajo.",
+    "email": "Para buscar tu correo institucional, decime tu legajo.",
+}
+
+
+def enmascarar_email(email):
+    """p*****@frd.utn.edu.ar: confirma el destino sin mostrar la dirección completa"""
+    usuario, _, dominio = email.partition("@")
+    return f"{usuario[:1]}{'*' * max(len(usuario) - 1, 3)}@{dominio}"
+
+
+MENSAJE_ERROR_CONSULTA = "Ocurrió un problema al consultar tu información académica. Probá de nuevo en unos minutos."
+
+
+def enviar_info_academica(legajo):
+    """Encola el correo con la información académica del legajo y retorna la respuesta para el chat"""
+    try:
+        info = consultar_info_academica(legajo)
+    except Exception:
+        logger.exception("Error consultando la información académica del legajo %s", legajo)
+        return MENSAJE_ERROR_CONSULTA
+    if not info["email"]:
+        return "No encuentro un correo institucional asociado a tu legajo. Decime un email para enviarte la información."
+    try:
+        # El envío real lo hace la cola en segundo plano
+        cola_correos.encolar(**correo_info_academica(info))
+    except Exception:
+        logger.exception("Error encolando el correo del legajo %s", legajo)
+        return "Ocurrió un problema al enviar el correo. ¿Podés confirmar otra dirección de email para reenviar la información?"
+    return "Te envié la información a tu correo institucional asociado al legajo."
+
+
+class MotorIntenciones:
+    """
+    Resuelve sin router ni agente las consultas académicas más frecuentes:
+    materias/carreras (se envían por correo) y el correo asociado al legajo.
+    El único dato a completar es el legajo: se toma del mensaje o del que
+    recuerda la sesión y, si falta, se pide y la intención queda pendiente para
+    el turno siguiente. También atiende la confirmación de un envío ofrecido.
+    Un mensaje con palabras fuera de su vocabulario es una pregunta libre y
+    sigue el camino normal.
+    """
+
+    def __init__(self):
+        self.resueltas = Counter()
+        self._lock = threading.Lock()
+
+    def detectar(self, mensaje):
+        """Intención del mensaje ('info' o 'email'), o None si es una pregunta libre"""
+        palabras = re.findall(r"[a-z0-9]+", normalizar_texto(mensaje).replace("e-mail", "email"))
+        intenciones, personal = set(), False
+        for palabra in palabras:
+            if PATRON_NUMERO_LEGAJO.fullmatch(palabra):
+                personal = True
+            elif palabra in INTENCION_POR_PALABRA:
+                intenciones.add(INTENCION_POR_PALABRA[palabra])
+            elif palabra in PALABRAS_RELLENO:
+                personal = personal or palabra in MARCAS_PERSONALES
+            else:
+                return None
+        if not personal or not intenciones:
+            return None
+        # "mandame mis materias al mail": el correo es el destino, no lo consultado
+        return "email" if intenciones == {"email"} else "info"
+
+    def interpretar(self, mensaje, sesion):
+        """
+        Respuesta determinística al mensaje (ya agregado al historial de la
+        sesión), o None si debe resolverlo el router y un agente
+        """
+        pendiente, sesion.intencion_pendiente = sesion.intencion_pendiente, None
+        texto = " ".join(re.findall(r"[a-z0-9]+", normalizar_texto(mensaje)))
+        if pendiente is not None:
+            clase, intencion = pendiente
+            if clase == "confirmacion" and PATRON_AFIRMACION.fullmatch(texto):
+                return self._resolver(intencion, sesion)
+            if clase == "confirmacion" and PATRON_NEGACION.fullmatch(texto):
+                self._contar("rechazadas")
+                return "De acuerdo. ¿Te ayudo con algo más?"
+            if clase == "legajo" and PATRON_SOLO_LEGAJO.fullmatch(normalizar_texto(mensaje)):
+                return self._resolver(intencion, sesion)
+
+        intencion = self.detectar(mensaje)
+        if intencion is None:
+            return None
+        match = PATRON_NUMERO_LEGAJO.search(texto)
+        if match:
+            sesion.legajo = int(match.group(0))
+        return self._resolver(intencion, sesion)
+
+    def _resolver(self, intencion, sesion):
+        legajo = sesion.legajo
+        if legajo is None:
+            sesion.intencion_pendiente = ("legajo", intencion)
+            self._contar("pedidos_legajo")
+            return PEDIDO_LEGAJO[intencion]
+        self._contar(intencion)
+        if intencion == "info":
+            return enviar_info_academica(legajo)
+
+        try:
+            email = consultar_info_academica(legajo)["email"]
+        except Exception:
+            # Una caída de la base no es un legajo sin correo
+            logger.exception("Error consultando el correo del legajo %s", legajo)
+            return MENSAJE_ERROR_CONSULTA
+        if not email:
+            return "No encuentro un correo institucional asociado a tu legajo. Verificá que el número sea correcto."
+        sesion.intencion_pendiente = ("confirmacion", "info")
+        return (f"Tu correo institucional asociado al legajo es {enmascarar_email(email)}. "
+                "¿Querés que te envíe ahí tus materias y carreras?")
+
+    def _contar(self, clave):
+        with self._lock:
+            self.resueltas[clave] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            return dict(self.resueltas)
+
+
+motor_intenciones = MotorIntenciones() if app.config['INTENCIONES'] else None
+
+# =============================================================================
+# AGENTE PRINCIPAL - Coordina todos los agentes
+# =============================================================================
+
+def analizar_consulta_academica(mensaje):
+    """
+    Detecta las consultas de materias/carreras con legajo que resuelve la rama
+    determinística de DATABASE. Retorna (es_sensible, legajo o None)
+    """
+    mensaje_min = mensaje.lower()
+    contiene_palabras_sensibles = any(k in mensaje_min for k in ["materia", "materias", "carrera", "carreras"]) \
+        and ("legajo" in mensaje_min or re.search(r"\b\d{4,6}\b", mensaje_min))
+    if not contiene_palabras_sensibles:
+        return False, None
+    # Extraer legajo (primer número de 4-6 dígitos o después de la palabra legajo)
+    match = re.search(r"legajo\D*(\d{4,6})", mensaje_min)
+    if not match:
+        match = re.search(r"\b(\d{4,6})\b", mensaje_min)
+    return True, int(match.group(1)) if match else None
+
+
+MENSAJE_OCUPADO = "El asistente está atendiendo muchas consultas en este momento. Probá de nuevo en unos segundos."
+
+
+class ChatbotAgentes:
+    def __init__(self, registro, contexto, cache_respuestas=None, especular=False, intenciones=None):
+        self.registro = registro
+        self.contexto = contexto
+        self.cache_respuestas = cache_respuestas
+        self.especular = especular
+        self.intenciones = intenciones
+
+    def _enrutar(self, mensaje, sesion, stream_mode="values"):
+        """
+        Agrega el mensaje al historial, resuelve las intenciones académicas
+        frecuentes sin LLM, detecta el tipo de consulta y resuelve la rama
+        determinística de DATABASE sensible.
+        Retorna (tipo_consulta, respuesta_directa, especulacion): respuesta_directa
+        es None cuando hay que ejecutar un agente y especulacion es la ejecución
+        especulativa ya confirmada, si la hubo.
+        """
         
-        response_content = ""
-        for event in events:
-            if "messages" in event and event["messages"]:
-                response_content = event["messages"][-1].content
+        # 1. Agregar mensaje al historial (el router no lo usa; el agente especulativo sí)
+        sesion.agregar_mensaje_usuario(mensaje)
+
+        # 1.5. Consultas académicas frecuentes: sin router ni agente
+        if self.intenciones is not None:
+            with medir("intenciones"):
+                respuesta_directa = self.intenciones.interpretar(mensaje, sesion)
+            if respuesta_directa is not None:
+                sesion.agregar_mensaje_ia(respuesta_directa)
+                sesion.tipo_consulta_actual = 'DATABASE'
+                return 'DATABASE', respuesta_directa, None
+
+        es_sensible, legajo = analizar_consulta_academica(mensaje)
+        if es_sensible and legajo is None:
+            legajo = sesion.legajo
+        especulacion = precarga = None
+
+        def adelantar_trabajo():
+            # El router va a consultar al LLM: mientras tanto se adelanta la consulta
+            # académica o se ejecuta el agente del turno anterior
+            nonlocal especulacion, precarga
+            if es_sensible:
+                if legajo is not None:
+                    precarga = precargar_info_academica(legajo)
+                return
+            tipo = sesion.tipo_consulta_actual
+            especulacion = EjecucionEspeculativa(
+                tipo, self.registro.obtener(tipo, especulativo=True), self.contexto.mensajes_para_agente(sesion, tipo),
+                stream_mode
+            )
+
+        # 2. Detectar tipo de consulta
+        try:
+            tipo_consulta = detectar_tipo_consulta(mensaje, sesion.tipo_consulta_actual,
+                                                   antes_de_llm=adelantar_trabajo if self.especular else None)
+        except Exception:
+            # Sin clasificación la especulación no se va a usar: se detiene y se cuenta el desperdicio
+            if especulacion is not None:
+                especulacion.descartar()
+            raise
+        logger.debug("Sesión %s: tipo_consulta=%s", sesion.id, tipo_consulta)
+        if especulacion is not None and not especulacion.resolver(tipo_consulta):
+            especulacion = None
         
-        # 5. Agregar respuesta al historial
-        self.chat_history.add_ai_message(response_content)
-        print(f"-{self.chat_history.messages}")
-        self.tipo_consulta_actual = tipo_consulta
+        # 2.5. Rama determinística para DATABASE sensible
+        if tipo_consulta == 'DATABASE' and es_sensible:
+            if legajo is None:
+                respuesta_chat = PEDIDO_LEGAJO["info"]
+                sesion.intencion_pendiente = ("legajo", "info")
+                sesion.agregar_mensaje_ia(respuesta_chat)
+                sesion.tipo_consulta_actual = tipo_consulta
+                return tipo_consulta, respuesta_chat, None
+            if precarga is not None:
+                try:
+                    precarga.result()
+                except Exception as e:
+                    logger.warning("Error en la precarga académica del legajo %s: %s", legajo, e)
+            respuesta_chat = enviar_info_academica(legajo)
+
+            # Guardar respuesta en historial y devolver
+            sesion.agregar_mensaje_ia(respuesta_chat)
+            sesion.tipo_consulta_actual = tipo_consulta
+            return tipo_consulta, respuesta_chat, None
+
+        return tipo_consulta, None, especulacion
+
+    def _eventos_agente(self, tipo_consulta, sesion, stream_mode, especulacion):
+        """Eventos del agente: los de la ejecución especulativa confirmada o los de una nueva"""
+        if especulacion is not None:
+            return especulacion.eventos()
+        return self.registro.obtener(tipo_consulta).stream(
+            {"messages": self.contexto.mensajes_para_agente(sesion, tipo_consulta)},
+            config={"callbacks": [InstrumentacionLLM("agente", tipo_consulta)]},
+            stream_mode=stream_mode
+        )
+
+    def _es_pregunta_frecuente(self, tipo_consulta, sesion):
+        """
+        Solo la primera pregunta SRAT de una conversación sin datos personales
+        previos se responde desde (y se guarda en) la caché semántica: las
+        siguientes dependen del contexto y DATABASE siempre es personal.
+        Mientras la caché no terminó de inicializarse se responde sin ella.
+        """
+        if self.cache_respuestas is None or tipo_consulta != 'SRAT' or sesion.tipo_consulta_actual == 'SRAT':
+            return False
+        if sesion.legajo is not None or sesion.resumen:
+            return False
+        if self.cache_respuestas.obtener_sin_esperar() is None:
+            return False
+        anteriores = sesion.chat_history.messages[:-1]
+        return not any(
+            CacheSemantica.contiene_datos_personales(m.content, es_pregunta=True)
+            for m in anteriores if m.type == "human"
+        )
+
+    def _buscar_respuesta_frecuente(self, mensaje, sesion):
+        with medir("cache_semantica"):
+            respuesta = self.cache_respuestas.obtener().buscar(mensaje)
+        if respuesta is not None:
+            logger.debug("Sesión %s: respuesta desde la caché semántica", sesion.id)
+        return respuesta
+
+    def registrar_ocupado(self, sesion):
+        """Responde el mensaje pendiente con el aviso de ocupado para no dejar el turno abierto"""
+        mensajes = sesion.chat_history.messages
+        if mensajes and mensajes[-1].type == "human":
+            sesion.agregar_mensaje_ia(MENSAJE_OCUPADO)
+
+    def _finalizar(self, sesion, tipo_consulta, response_content):
+        """Agrega la respuesta del agente al historial y arma el resultado"""
+        sesion.agregar_mensaje_ia(response_content)
+        logger.debug("Historial de la sesión %s: %s", sesion.id, sesion.chat_history.messages)
+        sesion.tipo_consulta_actual = tipo_consulta
         return {
             "response": response_content,
             "tipo_consulta": tipo_consulta
         }
 
+    def procesar_mensaje(self, mensaje, sesion):
+        """Procesa un mensaje de la sesión usando el agente apropiado"""
+        tipo_consulta, respuesta_directa, especulacion = self._enrutar(mensaje, sesion)
+        if respuesta_directa is not None:
+            return {
+                "response": respuesta_directa,
+                "tipo_consulta": tipo_consulta
+            }
+
+        # 2.6. Preguntas frecuentes de SRAT ya respondidas
+        frecuente = self._es_pregunta_frecuente(tipo_consulta, sesion)
+        if frecuente:
+            respuesta_cacheada = self._buscar_respuesta_frecuente(mensaje, sesion)
+            if respuesta_cacheada is not None:
+                return self._finalizar(sesion, tipo_consulta, respuesta_cacheada)
+
+        # 3-4. Ejecutar el agente apropiado (compartido entre sesiones) o usar la especulación
+        with medir("agente", tipo_consulta=tipo_consulta):
+            events = self._eventos_agente(tipo_consulta, sesion, "values", especulacion)
+            
+            response_content = ""
+            uso_herramientas = False
+            for event in events:
+                if "messages" in event and event["messages"]:
+                    response_content = event["messages"][-1].content
+                    uso_herramientas = any(isinstance(m, ToolMessage) for m in event["messages"])
+        
+        # Las respuestas que llamaron herramientas (p. ej. enviaron un correo) no se cachean
+        if frecuente and not uso_herramientas:
+            self.cache_respuestas.obtener().guardar(mensaje, response_content)
+
+        # 5. Agregar respuesta al historial; los turnos viejos se pliegan en el resumen
+        # después de responder (las respuestas directas y cacheadas no llaman al LLM)
+        resultado = self._finalizar(sesion, tipo_consulta, response_content)
+        self.contexto.programar_compactacion(sesion)
+        return resultado
+
+    def procesar_mensaje_stream(self, mensaje, sesion):
+        """
+        Igual que procesar_mensaje, pero genera eventos a medida que avanza el
+        agente: 'tipo_consulta', 'token' (fragmentos de texto), 'herramienta'
+        (inicio/fin de cada llamada a herramienta) y 'fin' con la respuesta completa.
+        """
+        tipo_consulta, respuesta_directa, especulacion = self._enrutar(mensaje, sesion, "messages")
+        yield "tipo_consulta", {"tipo_consulta": tipo_consulta}
+        if respuesta_directa is not None:
+            yield "token", {"contenido": respuesta_directa}
+            yield "fin", {"response": respuesta_directa, "tipo_consulta": tipo_consulta}
+            return
+
+        frecuente = self._es_pregunta_frecuente(tipo_consulta, sesion)
+        if frecuente:
+            respuesta_cacheada = self._buscar_respuesta_frecuente(mensaje, sesion)
+            if respuesta_cacheada is not None:
+                yield "token", {"contenido": respuesta_cacheada}
+                yield "fin", self._finalizar(sesion, tipo_consulta, respuesta_cacheada)
+                return
+
+        inicio = time.perf_counter()
+        events = self._eventos_agente(tipo_consulta, sesion, "messages", especulacion)
+
+        response_content = ""
+        uso_herramientas = False
+        for chunk, _metadata in events:
+            if isinstance(chunk, ToolMessage):
+                uso_herramientas = True
+                yield "herramienta", {"nombre": chunk.name, "estado": "fin"}
+                continue
+            if not isinstance(chunk, AIMessage):
+                continue
+            llamadas = getattr(chunk, "tool_call_chunks", None) or chunk.tool_calls
+            if llamadas:
+                # El texto previo a una llamada a herramienta no es la respuesta final
+                response_content = ""
+                for llamada in llamadas:
+                    if llamada.get("name"):
+                        yield "herramienta", {"nombre": llamada["name"], "estado": "inicio"}
+            if isinstance(chunk.content, str) and chunk.content:
+                response_content += chunk.content
+                yield "token", {"contenido": chunk.content}
+
+        histograma_etapas.observar(time.perf_counter() - inicio, etapa="agente", tipo_consulta=tipo_consulta)
+        if frecuente and not uso_herramientas:
+            self.cache_respuestas.obtener().guardar(mensaje, response_content)
+        yield "fin", self._finalizar(sesion, tipo_consulta, response_content)
+        self.contexto.programar_compactacion(sesion)
+
 # =============================================================================
 # INSTANCIA GLOBAL DEL CHATBOT
 # =============================================================================
 
-chatbot = ChatbotAgentes()
+registro_agentes = RegistroAgentes()
+gestor_contexto = GestorContexto(
+    llm_resumen=componente_router_llm,
+    turnos_verbatim=app.config['CONTEXTO_TURNOS_VERBATIM'],
+    lote_resumen=app.config['CONTEXTO_LOTE_RESUMEN'],
+    presupuestos=app.config['CONTEXTO_PRESUPUESTO_TOKENS'],
+    ejecutor=ThreadPoolExecutor(max_workers=2, thread_name_prefix="resumen"),
+)
+componente_cache_respuestas = None
+if app.config['CACHE_SEMANTICA']:
+    # El modelo de embeddings tarda en cargar: lo construye el precalentamiento, no la importación
+    componente_cache_respuestas = perezoso("cache_respuestas", lambda: CacheSemantica(
+        crear_vectorizador(app.config['CACHE_SEMANTICA_MODELO']),
+        umbral=float(app.config['CACHE_SEMANTICA_UMBRAL']) if app.config['CACHE_SEMANTICA_UMBRAL'] else None,
+        max_entradas=app.config['CACHE_SEMANTICA_MAX'],
+        ttl_segundos=app.config['CACHE_SEMANTICA_TTL_SEGUNDOS'],
+    ))
+chatbot = ChatbotAgentes(registro_agentes, gestor_contexto, componente_cache_respuestas, especular=app.config['ESPECULACION'],
+                         intenciones=motor_intenciones)
+
+
+def configurar_modelos(modelo_agentes, modelo_router):
+    """
+    Reemplaza los modelos de los agentes y del router/resumen (por ejemplo por
+    un modelo falso en benchmark.py) y recompila los agentes.
+    """
+    global registro_agentes
+    componente_llm.establecer(modelo_agentes)
+    componente_router_llm.establecer(modelo_router)
+    registro_agentes = RegistroAgentes()
+    chatbot.registro = registro_agentes
+
+def crear_historial():
+    """Historial persistente según HISTORIAL_BACKEND; None si es 'memoria' o la URI no es válida"""
+    if app.config['HISTORIAL_BACKEND'] != 'sql':
+        return None
+    try:
+        if app.config['HISTORIAL_DB_URI']:
+            engine = create_engine(app.config['HISTORIAL_DB_URI'], pool_pre_ping=True)
+        else:
+            with app.app_context():
+                engine = db.engine
+        historial = HistorialSQL(engine, app.config['HISTORIAL_FLUSH_SEGUNDOS'], app.config['HISTORIAL_LOTE_MAX'])
+    except Exception as e:
+        logger.error("No se pudo inicializar el historial persistente, se usa solo memoria: %s", e)
+        return None
+    historial.iniciar_poda(app.config['HISTORIAL_RETENCION_DIAS'] * 86400, app.config['HISTORIAL_PODA_SEGUNDOS'])
+    return historial
+
+historial_conversaciones = crear_historial()
+gestor_sesiones = GestorSesiones(
+    max_sesiones=app.config['SESIONES_MAX'],
+    ttl_segundos=app.config['SESIONES_TTL_SEGUNDOS'],
+    max_bytes=app.config['SESIONES_MAX_BYTES'],
+    historial=historial_conversaciones,
+)
+with app.app_context():
+    instrumentar_sql(db.engine)
+
+estado_arranque = {"precalentamiento_ms": None}
+_precalentamiento_iniciado = threading.Event()
+
+
+def precalentar():
+    """Crea los componentes pesados que si no se crearían con la primera consulta"""
+    inicio = time.perf_counter()
+    for componente in COMPONENTES.values():
+        try:
+            componente.obtener()
+        except Exception as e:
+            logger.error("Precalentamiento: error inicializando %s: %s", componente.nombre, e)
+    try:
+        registro_agentes.compilar_todos(especulativos=chatbot.especular)
+    except Exception as e:
+        logger.error("Precalentamiento: error compilando agentes: %s", e)
+    estado_arranque["precalentamiento_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    logger.info("Precalentamiento terminado en %.0fms", estado_arranque["precalentamiento_ms"])
+
+
+def iniciar_precalentamiento():
+    """Lanza el precalentamiento en segundo plano (una sola vez por proceso)"""
+    if _precalentamiento_iniciado.is_set():
+        return
+    _precalentamiento_iniciado.set()
+    threading.Thread(target=precalentar, daemon=True, name="precalentamiento").start()
 
 # =============================================================================
 # RUTAS FLASK
@@ -464,14 +3354,217 @@ chatbot = ChatbotAgentes()
 def index():
     return render_template('index.html')
 
+def respuesta_ocupado(reintentar_en):
+    """503 con Retry-After cuando el LLM está saturado"""
+    response = jsonify({"response": MENSAJE_OCUPADO, "ocupado": True, "reintentar_en": reintentar_en})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(reintentar_en)
+    return response
+
 @app.route('/chat', methods=['POST'])
 def chat():
     user_message = request.json.get('message')
+    sesion, es_nueva = gestor_sesiones.obtener(request.cookies.get(app.config['SESION_COOKIE']))
     
-    # Procesar mensaje con el sistema de agentes
-    result = chatbot.procesar_mensaje(user_message)
+    # Procesar mensaje con el sistema de agentes (un mensaje a la vez por sesión)
+    inicio = time.perf_counter()
+    try:
+        with sesion.lock:
+            try:
+                result = chatbot.procesar_mensaje(user_message, sesion)
+            except ServicioOcupado:
+                chatbot.registrar_ocupado(sesion)
+                raise
+        histograma_peticiones.observar(time.perf_counter() - inicio, endpoint='/chat', tipo_consulta=result["tipo_consulta"])
+        response = jsonify(result)
+    except ServicioOcupado as e:
+        response = respuesta_ocupado(e.reintentar_en)
+    gestor_sesiones.registrar_uso(sesion)
     
-    return jsonify(result)
+    if es_nueva:
+        response.set_cookie(app.config['SESION_COOKIE'], sesion.id, httponly=True, samesite='Lax')
+    return response
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Igual que /chat pero responde con Server-Sent Events a medida que avanza el agente"""
+    user_message = request.json.get('message')
+    sesion, es_nueva = gestor_sesiones.obtener(request.cookies.get(app.config['SESION_COOKIE']))
+
+    def generar():
+        inicio = time.perf_counter()
+        sesion.lock.acquire()
+        try:
+            for evento, datos in chatbot.procesar_mensaje_stream(user_message, sesion):
+                if evento == "fin":
+                    histograma_peticiones.observar(time.perf_counter() - inicio, endpoint='/chat/stream',
+                                                   tipo_consulta=datos["tipo_consulta"])
+                yield f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+        except ServicioOcupado as e:
+            chatbot.registrar_ocupado(sesion)
+            datos = {"response": MENSAJE_OCUPADO, "ocupado": True, "reintentar_en": e.reintentar_en}
+            yield f"event: error\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            logger.exception("Error en /chat/stream")
+            datos = {"response": "Lo siento, hubo un error al procesar tu mensaje. Inténtalo de nuevo."}
+            yield f"event: error\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+        finally:
+            sesion.lock.release()
+            gestor_sesiones.registrar_uso(sesion)
+
+    response = Response(stream_with_context(generar()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    if es_nueva:
+        response.set_cookie(app.config['SESION_COOKIE'], sesion.id, httponly=True, samesite='Lax')
+    return response
+
+def requiere_admin(vista):
+    """Protege un endpoint con el encabezado X-Admin-Token"""
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        token = app.config['ADMIN_TOKEN']
+        if not token or request.headers.get('X-Admin-Token') != token:
+            return jsonify({"error": "No autorizado"}), 403
+        return vista(*args, **kwargs)
+    return envoltura
+
+@app.route('/admin/cache/legajos/invalidar', methods=['POST'])
+@requiere_admin
+def admin_invalidar_cache_legajos():
+    legajo = (request.get_json(silent=True) or {}).get('legajo')
+    invalidar_cache_legajo(legajo)
+    return jsonify({"invalidado": legajo if legajo is not None else "todos"})
+
+@app.route('/admin/snapshot/refrescar', methods=['POST'])
+@requiere_admin
+def admin_refrescar_snapshot():
+    if componente_snapshot is None:
+        return jsonify({"error": "El snapshot académico no está habilitado (SNAPSHOT_ACADEMICO=1)"}), 409
+    if componente_snapshot.listo:
+        snapshot_academico.cargar()
+    else:
+        componente_snapshot.obtener()
+    invalidar_cache_legajo()
+    return jsonify(snapshot_academico.estadisticas())
+
+@app.route('/admin/cache/respuestas/limpiar', methods=['POST'])
+@requiere_admin
+def admin_limpiar_cache_respuestas():
+    """Vacía la caché semántica, por ejemplo después de cambiar el prompt de SRAT"""
+    if componente_cache_respuestas is None:
+        return jsonify({"error": "La caché semántica no está habilitada (CACHE_SEMANTICA=1)"}), 409
+    cache_respuestas = componente_cache_respuestas.obtener()
+    cache_respuestas.limpiar()
+    return jsonify(cache_respuestas.estadisticas())
+
+@app.route('/admin/envio-masivo', methods=['POST'])
+@requiere_admin
+def admin_envio_masivo():
+    """
+    Inicia en segundo plano el envío de la información académica a una lista de
+    legajos ({"legajos": [...]}) o a todos ({"todos": true}). Con "simulacion":
+    true solo arma los mensajes. Repetir un "lote" retoma un envío interrumpido.
+    """
+    datos = request.get_json(silent=True) or {}
+    legajos = datos.get('legajos')
+    if legajos is None and not datos.get('todos'):
+        return jsonify({"error": "Indicá 'legajos' (lista) o 'todos': true"}), 400
+    if legajos is not None and not isinstance(legajos, list):
+        return jsonify({"error": "'legajos' debe ser una lista"}), 400
+    lote = str(datos.get('lote') or EnvioMasivo.nuevo_lote())
+    try:
+        envio_masivo.iniciar(lote, legajos, simulacion=bool(datos.get('simulacion')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify({"lote": lote, "estado": f"/admin/envio-masivo/{lote}"}), 202
+
+@app.route('/admin/envio-masivo/<lote>')
+@requiere_admin
+def admin_estado_envio_masivo(lote):
+    resumen = envio_masivo.estado(lote)
+    if resumen is None:
+        return jsonify({"error": f"No hay registros del lote {lote}"}), 404
+    return jsonify(resumen)
+
+@app.route('/healthz')
+def healthz():
+    """El proceso está vivo y atiende pedidos (no verifica dependencias)"""
+    return jsonify({"estado": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    """Listo para responder consultas sin inicializaciones pendientes: 200 si todo está listo, 503 si no"""
+    componentes = {nombre: componente.estado() for nombre, componente in COMPONENTES.items()}
+    componentes["agentes"] = registro_agentes.estado()
+    listo = all(componente["listo"] for componente in componentes.values())
+    return jsonify({"listo": listo, "componentes": componentes}), 200 if listo else 503
+
+def estadisticas_generales():
+    return {
+        "sesiones": gestor_sesiones.estadisticas(),
+        "agentes": registro_agentes.estadisticas(),
+        "router": dict(estadisticas_router, en_curso=llamadas_router.en_curso()),
+        "cache_router": cache_router.estadisticas(),
+        "correos": cola_correos.estadisticas(),
+        "llm": limitador_llm.estadisticas(),
+        "contexto": gestor_contexto.estadisticas(),
+        "cache_legajos": cache_legajos.estadisticas(),
+        "snapshot_academico": snapshot_academico.estadisticas() if snapshot_academico else None,
+        "cache_respuestas": (componente_cache_respuestas.obtener().estadisticas()
+                             if componente_cache_respuestas is not None and componente_cache_respuestas.listo else None),
+        "historial": historial_conversaciones.estadisticas() if historial_conversaciones else None,
+        "especulacion": dict(resumen_especulacion(), habilitada=chatbot.especular),
+        "intenciones": motor_intenciones.estadisticas() if motor_intenciones is not None else None,
+        "arranque": dict(estado_arranque, importacion_ms=dict(TIEMPOS_IMPORTACION_MS)),
+    }
+
+@app.route('/estadisticas')
+def estadisticas():
+    return jsonify(estadisticas_generales())
+
+@app.route('/metrics')
+def metrics():
+    """Métricas en formato de texto de Prometheus"""
+    partes = [metrica.renderizar() for metrica in METRICAS]
+    partes += renderizar_estadisticas(estadisticas_generales())
+    return Response("\n".join(partes) + "\n", mimetype='text/plain; version=0.0.4')
+
+@app.cli.command("envio-masivo")
+@click.option("--legajos", default="", help="Legajos separados por coma.")
+@click.option("--archivo", type=click.File("r"), help="Archivo con un legajo por línea.")
+@click.option("--todos", is_flag=True, help="Todos los legajos de la base.")
+@click.option("--lote", default=None, help="Identificador del lote; repetirlo retoma un envío interrumpido.")
+@click.option("--simulacion", "--dry-run", is_flag=True, help="Arma los mensajes sin encolarlos.")
+def comando_envio_masivo(legajos, archivo, todos, lote, simulacion):
+    """Envía por correo la información académica de muchos legajos."""
+    lista = [l for l in legajos.split(",") if l.strip()]
+    if archivo is not None:
+        lista += [linea for linea in archivo if linea.strip()]
+    if not lista and not todos:
+        raise click.UsageError("Indicá --legajos, --archivo o --todos")
+    lote = lote or EnvioMasivo.nuevo_lote()
+    resumen = envio_masivo.ejecutar(lote, None if todos else lista, simulacion=simulacion)
+    if simulacion:
+        click.echo(f"Lote {lote} (simulación): {resumen['simulados']} correos armados, ninguno encolado")
+    else:
+        click.echo(f"Lote {lote}: {resumen['encolados']} correos encolados, esperando el envío...")
+        cola_correos.esperar()
+    click.echo(json.dumps(dict(resumen, correos=cola_correos.estadisticas()), ensure_ascii=False, indent=2))
+
+estado_arranque["carga_modulo_ms"] = round((time.perf_counter() - _inicio_carga) * 1000, 1)
+logger.info("Módulo cargado en %.0fms (importaciones: %s)", estado_arranque["carga_modulo_ms"],
+            ", ".join(f"{nombre}={ms:.0f}ms" for nombre, ms in TIEMPOS_IMPORTACION_MS.items()))
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Con el recargador de Flask el módulo corre dos veces: solo precalienta el proceso que atiende
+    if app.config['PRECALENTAR'] and (app.config['MODO_SERVIDOR'] == 'produccion'
+                                      or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        iniciar_precalentamiento()
+    if app.config['MODO_SERVIDOR'] == 'produccion':
+        from waitress import serve
+        logger.info("Servidor de producción en el puerto %d con %d hilos",
+                    app.config['SERVIDOR_PUERTO'], app.config['SERVIDOR_HILOS'])
+        serve(app, host='0.0.0.0', port=app.config['SERVIDOR_PUERTO'], threads=app.config['SERVIDOR_HILOS'])
+    else:
+        app.run(debug=True, threaded=True, port=app.config['SERVIDOR_PUERTO'])
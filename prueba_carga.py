@@ -0,0 +1,106 @@
+"""
+Prueba de carga contra un servidor del chatbot en ejecución.
+
+Simula N sesiones concurrentes (cada una con su propia cookie de sesión) que
+envían una conversación a /chat, y muestra el throughput y la latencia para
+cada nivel de concurrencia.
+
+Uso:
+    python prueba_carga.py --url http://localhost:5000 --sesiones 1,2,4,8 --turnos 4
+"""
+import argparse
+import http.cookiejar
+import json
+import statistics
+import threading
+import time
+import urllib.request
+
+CONVERSACION = [
+    "hola",
+    "no puedo ingresar al sistema",
+    "mi legajo es 50443",
+    "olvidé mi contraseña",
+    "qué materias doy? legajo 50443",
+    "gracias",
+]
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) por el método del rango más cercano"""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = max(0, min(len(ordenados) - 1, round(p / 100 * len(ordenados) + 0.5) - 1))
+    return ordenados[indice]
+
+
+def simular_sesion(url, turnos, conversacion, latencias, errores, lock):
+    """Una sesión: envía los turnos en orden, esperando cada respuesta"""
+    cliente = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    for i in range(turnos):
+        mensaje = conversacion[i % len(conversacion)]
+        peticion = urllib.request.Request(
+            f"{url}/chat",
+            data=json.dumps({"message": mensaje}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        inicio = time.perf_counter()
+        try:
+            with cliente.open(peticion, timeout=120) as respuesta:
+                respuesta.read()
+            with lock:
+                latencias.append(time.perf_counter() - inicio)
+        except Exception as e:
+            with lock:
+                errores.append(str(e))
+
+
+def medir_concurrencia(url, sesiones, turnos, conversacion=CONVERSACION, simular=simular_sesion):
+    """Ejecuta `sesiones` sesiones en paralelo y devuelve las métricas del nivel"""
+    latencias, errores, lock = [], [], threading.Lock()
+    hilos = [
+        threading.Thread(target=simular, args=(url, turnos, conversacion, latencias, errores, lock))
+        for _ in range(sesiones)
+    ]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+    return {
+        "sesiones": sesiones,
+        "peticiones": len(latencias),
+        "errores": len(errores),
+        "duracion_s": duracion,
+        "throughput_rps": len(latencias) / duracion if duracion else 0.0,
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p95_ms": percentil(latencias, 95) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+        "media_ms": statistics.mean(latencias) * 1000 if latencias else 0.0,
+    }
+
+
+def imprimir_tabla(resultados):
+    print(f"{'sesiones':>8} {'peticiones':>10} {'errores':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'escala':>7}")
+    base = resultados[0]["throughput_rps"] if resultados else 0
+    for r in resultados:
+        escala = r["throughput_rps"] / base if base else 0.0
+        print(f"{r['sesiones']:>8} {r['peticiones']:>10} {r['errores']:>7} {r['throughput_rps']:>8.2f} "
+              f"{r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} {r['p99_ms']:>8.0f} {escala:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del chatbot por niveles de concurrencia")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--sesiones", default="1,2,4,8", help="niveles de concurrencia separados por coma")
+    parser.add_argument("--turnos", type=int, default=4, help="mensajes por sesión")
+    args = parser.parse_args()
+
+    resultados = [medir_concurrencia(args.url, int(n), args.turnos) for n in args.sesiones.split(",")]
+    imprimir_tabla(resultados)
+
+
+if __name__ == "__main__":
+    main()